@@ -0,0 +1,336 @@
+'''
+Benchmarks for "Hash_table & Markov.py"
+
+Runs the HashTable hash strategies (builtin, and "polynomial": the original
+base-37 hash masked to 63 bits, which is not cell-for-cell the original
+table's placement) and the Markov backends over synthetic and real corpora
+at several sizes and orders, and reports:
+
+  - HashTable: lookup/update and count_all operations per second, probe
+    lengths, rehash counts and (with --memory) peak memory
+  - Markov: training and log_probability / score_many throughput per
+    backend and (with --memory) peak memory
+
+Results are printed and, with --output, saved as JSON so that runs can be
+compared between releases. --profile writes one cProfile stats file per
+case around the hot paths.
+
+usage: python3 "Hash_table & Markov benchmark.py" [--text FILE ...]
+           [--sizes N ...] [--orders K ...] [--backends B ...]
+           [--output FILE] [--memory] [--profile DIR]
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import cProfile
+import tracemalloc
+import importlib.util
+from collections import Counter
+
+
+MODULE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "Hash_table & Markov.py")
+SIZES = [10000, 100000, 1000000]
+ORDERS = [2, 4, 6]
+SEED = 1234
+# short texts scored per batch in the score_many benchmark
+SNIPPET_CHARS = 200
+SNIPPETS = 500
+
+
+def load_module():
+    '''
+    Import "Hash_table & Markov.py", whose file name is not a valid module name
+    '''
+
+    spec = importlib.util.spec_from_file_location("hash_table_markov",
+                                                  MODULE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def synthetic_text(n, seed=SEED):
+    '''
+    Generate n characters of pseudo-English text with a skewed letter
+    distribution, so that k-grams repeat the way they do in real speech
+    '''
+
+    rng = random.Random(seed)
+    letters = "etaoinshrdlucmfwypvbgkjqxz"
+    weights = [len(letters) - i for i in range(len(letters))]
+    words = ["".join(rng.choices(letters, weights, k=rng.randint(1, 9)))
+             for i in range(5000)]
+
+    out = []
+    size = 0
+    while size < n:
+        w = rng.choice(words)
+        out.append(w)
+        size += len(w) + 1
+
+    return " ".join(out)[:n]
+
+
+def kgrams(text, k):
+    '''
+    Return every (wrapped-around) k-gram of text, as Markov.get_k_k1 does
+    '''
+
+    s = text + text[:k]
+
+    return [s[i - k:i] for i in range(k, len(s))]
+
+
+class Hooks:
+
+    def __init__(self, memory=False, profile_dir=None):
+        '''
+        Optional instrumentation around each measured call: tracemalloc for
+        peak memory, and cProfile with one stats file per case in
+        "profile_dir"
+        '''
+
+        self.memory = memory
+        self.profile_dir = profile_dir
+        if profile_dir:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    def measure(self, name, func, *args):
+        '''
+        Call func(*args). Return its result, the elapsed seconds and the
+        peak traced memory in bytes (None without --memory).
+        '''
+
+        profiler = cProfile.Profile() if self.profile_dir else None
+        if self.memory:
+            tracemalloc.start()
+        if profiler:
+            profiler.enable()
+
+        start = time.perf_counter()
+        result = func(*args)
+        secs = time.perf_counter() - start
+
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(self.profile_dir,
+                                             name + ".prof"))
+        peak = None
+        if self.memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        return result, secs, peak
+
+
+def bench_hash(module, hooks, corpus, hash_name, keys):
+    '''
+    Count the keys of "keys" in a HashTable using the hash strategy
+    "hash_name", first with a lookup and an update per key, then with
+    count_all. Return a result record.
+    '''
+
+    hash_func = module.HASH_FUNCTIONS[hash_name]
+    case = "hash-{}-{}-{}".format(corpus, len(keys), hash_name)
+
+    def count_each():
+        table = module.HashTable(module.HASH_CELLS, 0, hash_func)
+        for key in keys:
+            table.update(key, table.lookup(key) + 1)
+        return table
+
+    def lookup_each(table):
+        for key in keys:
+            table.lookup(key)
+
+    def count_bulk():
+        table = module.HashTable(module.HASH_CELLS, 0, hash_func)
+        table.count_all(keys)
+        return table
+
+    table, count_secs, count_peak = hooks.measure(case + "-update",
+                                                  count_each)
+    _, lookup_secs, _ = hooks.measure(case + "-lookup", lookup_each, table)
+    _, bulk_secs, bulk_peak = hooks.measure(case + "-count_all", count_bulk)
+
+    probes = Counter(table.probe_lengths())
+    stats = table.probe_stats()
+
+    return {"bench": "hash",
+            "corpus": corpus,
+            "hash": hash_name,
+            "keys": len(keys),
+            "distinct": table.num,
+            "cells": table.size,
+            "rehashes": table.rehashes,
+            "update_ops_per_sec": 2 * len(keys) / count_secs,
+            "lookup_ops_per_sec": len(keys) / lookup_secs,
+            "count_all_keys_per_sec": len(keys) / bulk_secs,
+            "mean_probe": stats["mean"],
+            "max_probe": stats["max"],
+            "probe_histogram": {str(p): c for p, c in sorted(probes.items())},
+            "peak_bytes": count_peak,
+            "count_all_peak_bytes": bulk_peak}
+
+
+def bench_markov(module, hooks, corpus, text, k, backend):
+    '''
+    Train a k-order Markov model on "text" with the given backend and score
+    the text back, whole and as a batch of snippets. Return a result record.
+    '''
+
+    case = "markov-{}-{}-k{}-{}".format(corpus, len(text), k, backend)
+    snippets = [text[i:i + SNIPPET_CHARS]
+                for i in range(0, len(text), len(text) // SNIPPETS or 1)]
+    snippets = snippets[:SNIPPETS]
+
+    model, learn_secs, learn_peak = hooks.measure(
+        case + "-learn", module.Markov, k, text, None, backend)
+    _, score_secs, score_peak = hooks.measure(
+        case + "-log_probability", model.log_probability, text)
+    _, batch_secs, _ = hooks.measure(
+        case + "-score_many", model.score_many, snippets)
+
+    return {"bench": "markov",
+            "corpus": corpus,
+            "chars": len(text),
+            "k": k,
+            "backend": model._backend,
+            "k_entries": len(model.k_table),
+            "k1_entries": len(model.k1_table),
+            "learn_chars_per_sec": len(text) / learn_secs,
+            "log_probability_chars_per_sec": len(text) / score_secs,
+            "score_many_texts_per_sec": len(snippets) / batch_secs,
+            "learn_peak_bytes": learn_peak,
+            "log_probability_peak_bytes": score_peak}
+
+
+def run_suite(module, hooks, corpora, sizes, orders, backends):
+    '''
+    Run every benchmark over every corpus truncated to every size. Return
+    the list of result records.
+    '''
+
+    results = []
+
+    for corpus, text in corpora.items():
+        for size in sizes:
+            if size > len(text):
+                continue
+            sample = text[:size]
+            keys = kgrams(sample, orders[0])
+            for hash_name in module.HASH_FUNCTIONS:
+                results.append(bench_hash(module, hooks, corpus, hash_name,
+                                          keys))
+            cells = len(set(sample)) + 1
+            for k in orders:
+                for backend in backends:
+                    skip = None
+                    if backend == "dense" and \
+                            cells ** (k + 1) > module.DENSE_MAX_CELLS:
+                        skip = "code space too large for a dense table"
+                    else:
+                        try:
+                            results.append(bench_markov(
+                                module, hooks, corpus, sample, k, backend))
+                        except ValueError as e:
+                            # backend cannot hold this order's codes
+                            skip = str(e)
+                    if skip:
+                        results.append({"bench": "markov", "corpus": corpus,
+                                        "chars": size, "k": k,
+                                        "backend": backend, "skipped": skip})
+
+    return results
+
+
+def environment():
+    '''
+    Describe the machine and library versions the results were taken on
+    '''
+
+    import numpy
+
+    return {"python": platform.python_version(),
+            "numpy": numpy.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpus": os.cpu_count(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+
+def print_report(results):
+    '''
+    Print one line per result record
+    '''
+
+    for res in results:
+        if res["bench"] == "hash":
+            print("hash   {corpus:>10} {keys:>9} keys  {hash:<10} "
+                  "update {update_ops_per_sec:>11,.0f}/s  "
+                  "lookup {lookup_ops_per_sec:>11,.0f}/s  "
+                  "count_all {count_all_keys_per_sec:>11,.0f}/s  "
+                  "probe mean {mean_probe:.2f} max {max_probe}  "
+                  "rehashes {rehashes}".format(**res))
+        elif "skipped" in res:
+            print("markov {corpus:>10} {chars:>9} chars k={k:<2} "
+                  "{backend:<7} skipped: {skipped}".format(**res))
+        else:
+            print("markov {corpus:>10} {chars:>9} chars k={k:<2} "
+                  "{backend:<7} learn {learn_chars_per_sec:>12,.0f} ch/s  "
+                  "score {log_probability_chars_per_sec:>12,.0f} ch/s  "
+                  "batch {score_many_texts_per_sec:>9,.0f} texts/s"
+                  .format(**res))
+        if res.get("peak_bytes") or res.get("learn_peak_bytes"):
+            print("       peak memory {:,} bytes".format(
+                res.get("peak_bytes") or res.get("learn_peak_bytes")))
+
+
+def go():
+    '''
+    Interprets command line arguments and runs the benchmark suite
+    '''
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--text", nargs="*", default=[],
+                        help="real corpora to benchmark besides the "
+                             "synthetic one")
+    parser.add_argument("--sizes", nargs="*", type=int, default=SIZES)
+    parser.add_argument("--orders", nargs="*", type=int, default=ORDERS)
+    parser.add_argument("--backends", nargs="*",
+                        default=["hash", "dense", "sparse"])
+    parser.add_argument("--output", help="save the results as JSON here")
+    parser.add_argument("--memory", action="store_true",
+                        help="record peak memory with tracemalloc")
+    parser.add_argument("--profile", metavar="DIR",
+                        help="write cProfile stats for every case to DIR")
+    args = parser.parse_args()
+
+    module = load_module()
+    hooks = Hooks(args.memory, args.profile)
+
+    corpora = {"synthetic": synthetic_text(max(args.sizes))}
+    for path in args.text:
+        with open(path, "r") as f:
+            corpora[os.path.basename(path)] = f.read()
+
+    results = run_suite(module, hooks, corpora, args.sizes, args.orders,
+                        args.backends)
+    print_report(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"environment": environment(), "results": results}, f,
+                      indent=2)
+
+
+if __name__ == "__main__":
+    go()
@@ -1,62 +1,184 @@
 ### Hash table
 
+import mmap
+import bisect
+import struct
+from array import array
+from collections import Counter
+
 
 TOO_FULL = 0.5
 GROWTH_RATIO = 2
+# full hashes are kept in a signed 64-bit array, so they are masked to 63 bits
+HASH_MASK = (1 << 63) - 1
+# 64-bit golden-ratio multiplier used to spread builtin hashes
+GOLDEN = 0x9E3779B97F4A7C15
+
+
+def builtin_hash(key):
+    '''
+    Default hash strategy: Python's builtin hash (cached on str objects),
+    multiplied by a 64-bit odd constant and folded so that structured keys
+    such as consecutive integers still land in well-spread cells. Note that
+    str hashes are randomised per process.
+    '''
+
+    h = (hash(key) * GOLDEN) & 0xFFFFFFFFFFFFFFFF
+
+    return (h ^ (h >> 32)) & HASH_MASK
+
+
+def polynomial_hash(key):
+    '''
+    The original per-character polynomial hash (base 37) over str(key),
+    masked to 63 bits so that it fits the hash array. For keys whose
+    polynomial reaches 2**63 the home cells therefore differ from the
+    original table's h % size. Slow for long keys; kept for comparison.
+    '''
+
+    h = 0
+    k = 37
+
+    for char in str(key):
+        h = h * k + ord(char)
+
+    return h & HASH_MASK
+
+
+HASH_FUNCTIONS = {"builtin": builtin_hash, "polynomial": polynomial_hash}
 
 
 class HashTable:
 
-    def __init__(self, cells, defval):
+    def __init__(self, cells, defval, hash_func=builtin_hash,
+                 too_full=TOO_FULL, growth_ratio=GROWTH_RATIO, expected=None):
         '''
         Construct a new hash table with a fixed number of cells equal to the
         parameter "cells", and which yields the value defval upon a lookup to a
         key that has not previously been inserted
+
+        "hash_func" maps a key to a non-negative integer below 2**63, either a
+        callable or a name from HASH_FUNCTIONS.
+
+        The table grows by "growth_ratio" whenever more than "too_full" of its
+        cells are occupied. If the number of keys is known in advance, pass it
+        as "expected" and the table is sized so that it never has to grow.
+
+        The cells are stored as three parallel arrays instead of one list per
+        cell: the keys, the values and the full hash of each key. An empty
+        cell costs two pointers and eight bytes of hash. A one-byte-per-cell
+        occupancy map lets iteration jump over empty regions.
         '''
 
-        self.size = cells
+        if not 0 < too_full < 1:
+            raise ValueError("too_full must be between 0 and 1")
+        if growth_ratio <= 1:
+            raise ValueError("growth_ratio must be greater than 1")
+
+        self.too_full = too_full
+        self.growth_ratio = growth_ratio
+        self.size = max(cells, self.__cells_for(expected or 0))
         self.num = 0
+        self.rehashes = 0
         self.defval = defval
-        self.table = [[None, self.defval].copy() for i in range(self.size)]
+        if isinstance(hash_func, str):
+            hash_func = HASH_FUNCTIONS[hash_func]
+        self._hash = hash_func
+        self.__allocate(self.size)
 
-    def __get_hash(self, key):
+    def __cells_for(self, count):
         '''
-        Convert a string into a hash value
+        Smallest number of cells that holds "count" keys without growing
         '''
 
-        h = 0
-        k = 37
+        return int(count / self.too_full) + 1
 
-        for char in str(key):
-            h = h * k + ord(char)
+    def __allocate(self, cells):
+        '''
+        Reset the storage to "cells" empty cells
+        '''
 
-        return h % self.size
+        self._keys = [None] * cells
+        self._vals = [self.defval] * cells
+        self._hashes = array('q', bytes(8 * cells))
+        self._used = bytearray(cells)
 
-    def lookup(self, key):
+    def __occupied(self, used=None):
         '''
-        Retrieve the value associated with the specified key in the hash table,
-        or return the default value if it has not previously been inserted.
+        Yield the positions of the occupied cells in order. The occupancy map
+        ("used", by default the table's own) is searched with bytearray.find,
+        so runs of empty cells are skipped without a Python-level step per
+        cell.
+        '''
+
+        if used is None:
+            used = self._used
+        pos = used.find(1)
+
+        while pos != -1:
+            yield pos
+            pos = used.find(1, pos + 1)
+
+    def __probe(self, key, h):
         '''
+        Robin Hood lookup. Return (pos, found): the cell holding "key", or the
+        cell where it belongs if it is absent. Within a run of occupied cells
+        the entries are ordered by home cell, so the search stops at the first
+        resident that sits closer to its home than "key" would.
+
+        Stored hashes are compared before the keys themselves, so most
+        collisions are rejected without a key comparison.
+        '''
+
+        keys = self._keys
+        hashes = self._hashes
+        size = self.size
+        pos = h % size
+        dist = 0
+
+        while keys[pos] is not None:
+            resident = hashes[pos]
+            if resident == h and keys[pos] == key:
+                return pos, True
+            if (pos - resident) % size < dist:
+                break
+            pos = (pos + 1) % size
+            dist += 1
 
-        h = self.__get_hash(key)
-        val = self.defval
-        stop = False
-        found = False
-        pos = h
+        return pos, False
 
-        while (self.table[pos][0] is not None) and (not found) and (not stop):
+    def __place(self, pos, key, h, val):
+        '''
+        Insert a new entry at cell "pos", shifting the rest of its run one
+        cell to the right to make room
+        '''
 
-            if self.table[pos][0] == key:
-                found = True
-                val = self.table[pos][1]
+        keys, vals, hashes = self._keys, self._vals, self._hashes
+        size = self.size
 
-            else:
-                pos = (pos + 1) % self.size
+        while keys[pos] is not None:
+            keys[pos], key = key, keys[pos]
+            vals[pos], val = val, vals[pos]
+            hashes[pos], h = h, hashes[pos]
+            pos = (pos + 1) % size
 
-            if pos == h:
-                stop = True
+        keys[pos] = key
+        vals[pos] = val
+        hashes[pos] = h
+        self._used[pos] = 1
 
-        return val
+    def lookup(self, key):
+        '''
+        Retrieve the value associated with the specified key in the hash table,
+        or return the default value if it has not previously been inserted.
+        '''
+
+        pos, found = self.__probe(key, self._hash(key))
+
+        if not found:
+            return self.defval
+
+        return self._vals[pos]
 
     def update(self, key, val):
         '''
@@ -65,120 +187,1095 @@ class HashTable:
         value "val".
         '''
 
-        h = self.__get_hash(key)
+        h = self._hash(key)
+        pos, found = self.__probe(key, h)
 
-        if self.table[h][0] is None:
-            self.table[h][0] = key
-            self.table[h][1] = val
-            self.num += 1
+        if found:
+            self._vals[pos] = val
+            return
 
-        else:
+        self.__place(pos, key, h, val)
+        self.num += 1
+
+        if self.num / self.size > self.too_full:
+            self.__rehash()
+
+    def lookup_many(self, keys):
+        '''
+        Return the list of values of "keys", as lookup would
+        '''
+
+        return [self.lookup(key) for key in keys]
+
+    def get(self, key, default=None):
+        '''
+        Return the value of "key", or "default" if it is not present
+        '''
 
-            if self.table[h][0] == key:
-                self.table[h][1] = val
+        pos, found = self.__probe(key, self._hash(key))
 
-            else:
-                h = (h + 1) % self.size
+        if not found:
+            return default
 
-                while (self.table[h][0] is not None) and \
-                        (self.table[h][0] != key):
-                    h = (h + 1) % self.size
+        return self._vals[pos]
 
-                if self.table[h][0] is None:
-                    self.table[h][0] = key
-                    self.table[h][1] = val
-                    self.num += 1
+    def __len__(self):
+        return self.num
 
-                else:
-                    self.table[h][1] = val
+    def __contains__(self, key):
+        return self.__probe(key, self._hash(key))[1]
 
-        if self.num / self.size > TOO_FULL:
+    def __getitem__(self, key):
+        pos, found = self.__probe(key, self._hash(key))
+
+        if not found:
+            raise KeyError(key)
+
+        return self._vals[pos]
+
+    def __setitem__(self, key, val):
+        self.update(key, val)
+
+    def __delitem__(self, key):
+        if not self.delete(key):
+            raise KeyError(key)
+
+    def __iter__(self):
+        '''
+        Lazily yield the keys, in cell order. The table must not be modified
+        while it is being iterated over.
+        '''
+
+        keys = self._keys
+
+        for pos in self.__occupied():
+            yield keys[pos]
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        '''
+        Lazily yield the values, in cell order
+        '''
+
+        vals = self._vals
+
+        for pos in self.__occupied():
+            yield vals[pos]
+
+    def items(self):
+        '''
+        Lazily yield the (key, value) pairs, in cell order
+        '''
+
+        keys, vals = self._keys, self._vals
+
+        for pos in self.__occupied():
+            yield keys[pos], vals[pos]
+
+    def increment(self, key, delta=1):
+        '''
+        Add "delta" to the value of "key" (a missing key counts from 0) with a
+        single probe, and return the new value
+        '''
+
+        h = self._hash(key)
+        pos, found = self.__probe(key, h)
+
+        if found:
+            val = self._vals[pos] + delta
+            self._vals[pos] = val
+            return val
+
+        self.__place(pos, key, h, delta)
+        self.num += 1
+
+        if self.num / self.size > self.too_full:
             self.__rehash()
 
+        return delta
+
+    def delete(self, key):
+        '''
+        Remove "key" from the hash table. Return True if it was present.
+        The entries after it in its run are shifted one cell back, so no
+        tombstones are left behind and later probes stay short.
+        '''
+
+        pos, found = self.__probe(key, self._hash(key))
+
+        if not found:
+            return False
+
+        keys, vals, hashes = self._keys, self._vals, self._hashes
+        size = self.size
+        nxt = (pos + 1) % size
+
+        while keys[nxt] is not None and (nxt - hashes[nxt]) % size > 0:
+            keys[pos] = keys[nxt]
+            vals[pos] = vals[nxt]
+            hashes[pos] = hashes[nxt]
+            pos = nxt
+            nxt = (nxt + 1) % size
+
+        keys[pos] = None
+        vals[pos] = self.defval
+        hashes[pos] = 0
+        self._used[pos] = 0
+        self.num -= 1
+
+        return True
+
+    def delete_if(self, test):
+        '''
+        Remove every entry whose value satisfies test(value). Return the number
+        of entries removed.
+        '''
+
+        doomed = [key for key, val in self.items() if test(val)]
+
+        for key in doomed:
+            self.delete(key)
+
+        return len(doomed)
+
+    def update_many(self, pairs):
+        '''
+        Set the value of every (key, value) pair in "pairs", growing the
+        table at most once
+        '''
+
+        pairs = dict(pairs)
+        self.reserve(self.num + len(pairs))
+
+        for key, val in pairs.items():
+            self.update(key, val)
+
+    def count_all(self, keys, delta=1):
+        '''
+        Add "delta" to the value of every key in "keys", once per occurrence.
+        Occurrences are tallied first, so each distinct key is hashed and
+        probed once and the table grows at most once.
+        '''
+
+        counts = Counter(keys)
+        self.reserve(self.num + len(counts))
+
+        for key, cnt in counts.items():
+            self.increment(key, cnt * delta)
+
+    def probe_lengths(self):
+        '''
+        Yield, for every stored key, how many cells past its home cell it
+        ended up (0 means it sits in its home cell)
+        '''
+
+        for pos in self.__occupied():
+            yield (pos - self._hashes[pos]) % self.size
+
+    def probe_stats(self):
+        '''
+        Return a dictionary with the maximum and mean probe length over the
+        stored keys
+        '''
+
+        longest = 0
+        total = 0
+
+        for length in self.probe_lengths():
+            longest = max(longest, length)
+            total += length
+
+        return {"max": longest, "mean": total / self.num if self.num else 0.0}
+
+    def save(self, path):
+        '''
+        Write the table to "path" in the memory-mappable format read by
+        load_table. Keys must all be strings or all be integers, and values
+        must be integers.
+        '''
+
+        with open(path, "wb") as f:
+            write_table(f, self.items())
+
+    def reserve(self, count):
+        '''
+        Grow the table, if needed, so that it holds "count" keys in total
+        without further rehashing
+        '''
+
+        cells = self.__cells_for(count)
+        if cells > self.size:
+            self.__migrate(cells)
+
     def __rehash(self):
         '''
         Expand the size of the hash table and migrate all the data into the
         proper location in the newly-expanded hash table once the fraction of
-        occupied cells grows beyond the TOO_FULL after an update.∂
+        occupied cells grows beyond the too_full after an update.
         '''
-        keys = [pair[0] for pair in self.table if pair[0] is not None]
-        vals = [pair[1] for pair in self.table if pair[1] != self.defval]
 
-        self.num = 0
-        self.size *= GROWTH_RATIO
-        self.table = [[None, self.defval].copy() for i in range(self.size)]
+        self.__migrate(max(self.size + 1, int(self.size * self.growth_ratio)))
+
+    def __migrate(self, cells):
+        '''
+        Move every entry into a fresh table of "cells" cells in one pass.
+        The stored hashes give each entry's new home cell directly and the
+        keys are known to be distinct, so nothing is rehashed or compared.
+        '''
+
+        old_keys, old_vals, old_hashes = self._keys, self._vals, self._hashes
+        old_used = self._used
+        self.size = cells
+        self.rehashes += 1
+        self.__allocate(cells)
+        keys, hashes = self._keys, self._hashes
+
+        for old in self.__occupied(old_used):
+            key, val, h = old_keys[old], old_vals[old], old_hashes[old]
+            pos = h % cells
+            dist = 0
+            while keys[pos] is not None and \
+                    (pos - hashes[pos]) % cells >= dist:
+                pos = (pos + 1) % cells
+                dist += 1
+            self.__place(pos, key, h, val)
+
+
+### Memory-mappable snapshots
+#
+# A table is written as one section, 8-byte aligned, little-endian:
+#
+#   header   magic "HTBL", key kind (0 = str, 1 = int), entry count n and
+#            the byte length of the key blob
+#   keys     n int64 keys (int tables), or n + 1 uint64 offsets into the
+#            key blob (str tables), in ascending key order
+#   values   n int64 values, in the same order
+#   blob     the UTF-8 encoded str keys, concatenated
+#
+# Keys are sorted, so a mapped table is searched by bisection directly in
+# the mapped pages without building any Python objects up front.
+
+TABLE_MAGIC = b"HTBL"
+TABLE_HEADER = struct.Struct("<4sB3xQQ")
+STR_KEYS = 0
+INT_KEYS = 1
+
+
+def write_table(f, items, kind=None):
+    '''
+    Write the (key, value) pairs in "items" as a table section to the binary
+    file object "f", starting at its current (8-byte aligned) position
+
+    "kind" is STR_KEYS or INT_KEYS; by default it is taken from the keys,
+    and an empty table is written as a str table.
+    '''
+
+    items = list(items)
+
+    if kind is None:
+        kind = INT_KEYS if items and isinstance(items[0][0], int) \
+            else STR_KEYS
+
+    if kind == STR_KEYS and all(isinstance(key, str) for key, val in items):
+        encoded = sorted((key.encode("utf-8"), val) for key, val in items)
+        blob = b"".join(key for key, val in encoded)
+        offsets = array("Q", [0])
+        for key, val in encoded:
+            offsets.append(offsets[-1] + len(key))
+        keys = offsets
+        vals = array("q", [val for key, val in encoded])
+    elif kind == INT_KEYS and all(isinstance(key, int) for key, val in items):
+        blob = b""
+        items.sort()
+        keys = array("q", [key for key, val in items])
+        vals = array("q", [val for key, val in items])
+    else:
+        raise TypeError("keys must be all str (STR_KEYS) "
+                        "or all int (INT_KEYS)")
+
+    f.write(TABLE_HEADER.pack(TABLE_MAGIC, kind, len(items), len(blob)))
+    f.write(keys.tobytes())
+    f.write(vals.tobytes())
+    f.write(blob)
+    f.write(bytes(-len(blob) % 8))
+
+
+class _StrKeys:
+    '''
+    Read-only sequence view of the encoded keys of a mapped str table
+    '''
+
+    def __init__(self, offsets, blob):
+        self._offsets = offsets
+        self._blob = blob
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self._blob[self._offsets[i]:self._offsets[i + 1]])
+
+
+class MappedTable:
+
+    def __init__(self, buf, offset=0, defval=None):
+        '''
+        Open the table section written by write_table at byte "offset" of the
+        buffer "buf" (typically an mmap). Nothing is copied: lookups bisect
+        the sorted keys in place. Lookups of missing keys yield "defval".
+        '''
+
+        magic, kind, n, blob_len = TABLE_HEADER.unpack_from(buf, offset)
+        if magic != TABLE_MAGIC:
+            raise ValueError("not a hash table snapshot")
+
+        view = memoryview(buf)
+        pos = offset + TABLE_HEADER.size
+        if kind == STR_KEYS:
+            offsets = view[pos:pos + 8 * (n + 1)].cast("Q")
+            pos += 8 * (n + 1)
+        else:
+            keys = view[pos:pos + 8 * n].cast("q")
+            pos += 8 * n
+        self._vals = view[pos:pos + 8 * n].cast("q")
+        pos += 8 * n
+
+        if kind == STR_KEYS:
+            keys = _StrKeys(offsets, view[pos:pos + blob_len])
+
+        self._kind = kind
+        self._keys = keys
+        self.num = n
+        self.end = pos + blob_len + (-blob_len % 8)
+        self.defval = defval
+
+    def __find(self, key):
+        '''
+        Return the index of "key" among the sorted keys, or -1
+        '''
+
+        if self._kind == STR_KEYS:
+            if not isinstance(key, str):
+                return -1
+            key = key.encode("utf-8")
+        elif not isinstance(key, int):
+            return -1
+
+        i = bisect.bisect_left(self._keys, key)
+        if i < self.num and self._keys[i] == key:
+            return i
+
+        return -1
+
+    def lookup(self, key):
+        '''
+        Retrieve the value associated with "key", or the default value
+        '''
+
+        i = self.__find(key)
+
+        return self.defval if i < 0 else self._vals[i]
+
+    def get(self, key, default=None):
+        i = self.__find(key)
+
+        return default if i < 0 else self._vals[i]
+
+    def __len__(self):
+        return self.num
+
+    def __contains__(self, key):
+        return self.__find(key) >= 0
+
+    def __getitem__(self, key):
+        i = self.__find(key)
+
+        if i < 0:
+            raise KeyError(key)
+
+        return self._vals[i]
+
+    def __iter__(self):
+        for i in range(self.num):
+            yield self.__key(i)
+
+    def __key(self, i):
+        if self._kind == STR_KEYS:
+            return self._keys[i].decode("utf-8")
+
+        return self._keys[i]
+
+    def items(self):
+        '''
+        Lazily yield the (key, value) pairs in ascending key order
+        '''
+
+        for i in range(self.num):
+            yield self.__key(i), self._vals[i]
+
+    def int_arrays(self):
+        '''
+        Return the sorted keys and the values of an int table as two int64
+        memoryviews into the mapped buffer
+        '''
+
+        if self._kind != INT_KEYS:
+            raise TypeError("table keys are not integers")
+
+        return self._keys, self._vals
+
+
+def load_table(path, defval=None):
+    '''
+    Memory-map a table written by HashTable.save and return it as a
+    read-only MappedTable
+    '''
+
+    with open(path, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
-        for k, v in zip(keys, vals):
-            self.update(k, v)
+    return MappedTable(buf, 0, defval)
 
 
 
 
 import sys
-import math
-import hash_table
+import heapq
+import numpy as np
+from multiprocessing import Pool
 
 HASH_CELLS = 57
+# saved models: magic, order k, alphabet size and the byte length of the
+# UTF-8 encoded alphabet, followed by the alphabet (padded to 8 bytes) and
+# the k and k+1 count tables as two write_table sections
+MARKOV_MAGIC = b"MARKOV01"
+MARKOV_HEADER = struct.Struct("<8sQQQ")
+# largest n-gram code that still fits an int64 array
+MAX_INT_CODE = 2 ** 63 - 1
+# count table backends, and the largest code space "auto" keeps dense
+BACKENDS = ("auto", "hash", "dense", "sparse")
+DENSE_MAX_CELLS = 2 ** 22
+# parallel training splits the text into this many shards per process
+SHARDS_PER_PROCESS = 4
+# characters read at a time when training from a file
+CHUNK_SIZE = 1 << 20
+
+
+class DenseCounts:
+
+    def __init__(self, counts):
+        '''
+        Count table over the codes 0 .. len(counts) - 1, stored as the int64
+        array "counts" indexed by code
+        '''
+
+        self.counts = counts
+
+    @classmethod
+    def from_codes(cls, codes, cells):
+        '''
+        Count the occurrences of each code in the array "codes"
+        '''
+
+        codes = np.asarray(codes, dtype=np.int64)
+
+        return cls(np.bincount(codes, minlength=cells).astype(np.int64))
+
+    def lookup(self, key):
+        if 0 <= key < len(self.counts):
+            return int(self.counts[key])
+
+        return 0
+
+    def lookup_many(self, keys):
+        '''
+        Return the array of counts of the array of codes "keys"
+        '''
+
+        return self.counts[np.asarray(keys, dtype=np.int64)]
+
+    def add(self, keys, counts):
+        '''
+        Add "counts" to the counts of the distinct codes "keys" (counts may
+        be negative; nothing is allowed to drop below zero)
+        '''
+
+        keys = np.asarray(keys, dtype=np.int64)
+        self.counts[keys] = np.maximum(self.counts[keys] + counts, 0)
+
+    def __len__(self):
+        return int(np.count_nonzero(self.counts))
+
+    def items(self):
+        '''
+        Yield the (code, count) pairs of the codes seen at least once
+        '''
+
+        seen = np.flatnonzero(self.counts)
+
+        return zip(seen.tolist(), self.counts[seen].tolist())
+
+    def delete_if(self, test):
+        '''
+        Zero every non-zero count for which test(counts) is true; "test" is
+        applied to the whole array. Return the number of codes removed.
+        '''
+
+        doomed = (self.counts != 0) & test(self.counts)
+        self.counts[doomed] = 0
+
+        return int(np.count_nonzero(doomed))
+
+
+class SparseCounts:
+
+    def __init__(self, keys, counts):
+        '''
+        Count table stored as the sorted array of distinct codes "keys" and
+        the matching array "counts"; lookups are binary searches
+        '''
+
+        self.keys = keys
+        self.counts = counts
+
+    @classmethod
+    def from_codes(cls, codes):
+        '''
+        Count the occurrences of each code in the array "codes"
+        '''
+
+        keys, counts = np.unique(np.asarray(codes, dtype=np.int64),
+                                 return_counts=True)
+
+        return cls(keys, counts.astype(np.int64))
+
+    def lookup(self, key):
+        return int(self.lookup_many(np.array([key], dtype=np.int64))[0])
+
+    def lookup_many(self, keys):
+        '''
+        Return the array of counts of the array of codes "keys"
+        '''
+
+        if not len(self.keys):
+            return np.zeros(len(keys), dtype=np.int64)
+
+        pos = np.searchsorted(self.keys, keys)
+        pos[pos == len(self.keys)] = 0
+        found = self.keys[pos] == keys
+
+        return np.where(found, self.counts[pos], 0)
+
+    def add(self, keys, counts):
+        '''
+        Add "counts" to the counts of the distinct codes "keys" (counts may
+        be negative). Codes whose count drops to zero or below are removed.
+        The arrays are rebuilt, so the cost is linear in the table size.
+        '''
+
+        merged, inverse = np.unique(np.concatenate([self.keys, keys]),
+                                    return_inverse=True)
+        totals = np.zeros(len(merged), dtype=np.int64)
+        np.add.at(totals, inverse, np.concatenate([self.counts, counts]))
+        keep = totals > 0
+        self.keys = merged[keep]
+        self.counts = totals[keep]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def items(self):
+        '''
+        Yield the (code, count) pairs in ascending code order
+        '''
+
+        return zip(self.keys.tolist(), self.counts.tolist())
+
+    def delete_if(self, test):
+        '''
+        Drop every code for which test(counts) is true; "test" is applied to
+        the whole array. Return the number of codes removed.
+        '''
+
+        doomed = test(self.counts)
+        self.keys = self.keys[~doomed]
+        self.counts = self.counts[~doomed]
+
+        return int(np.count_nonzero(doomed))
 
 
 ### Markov
 
+def count_codes(codes, backend, cells):
+    '''
+    Count the occurrences of each code in the array "codes", which lie in
+    range(cells), in a table of the given backend ("dense", "sparse" or
+    "hash")
+    '''
+
+    if backend == "dense":
+        return DenseCounts.from_codes(codes, cells)
+
+    if backend == "sparse":
+        return SparseCounts.from_codes(codes)
+
+    keys, counts = np.unique(codes, return_counts=True)
+    table = HashTable(HASH_CELLS, 0, expected=len(keys))
+    table.update_many(zip(keys.tolist(), counts.tolist()))
+
+    return table
+
+
 class Markov:
 
-    def __init__(self, k, s):
+    def __init__(self, k, s="", alphabet=None, backend="auto", processes=1,
+                 pool=None):
         '''
         Construct a new k-order Markov model using the statistics of string "s"
+
+        Character sequences are stored as integer codes over "alphabet", which
+        must contain every character of "s". By default the alphabet is the
+        characters seen so far, and it grows as partial_fit sees new ones.
+
+        "backend" selects how the counts are stored: "hash" (a HashTable),
+        "dense" (an array indexed by code) or "sparse" (sorted code and count
+        arrays). "auto" picks dense when the (k+1)-character code space has
+        at most DENSE_MAX_CELLS codes, sparse when codes fit in 64 bits and
+        hash otherwise. "dense" is refused for larger code spaces.
+
+        With "processes" > 1 the counting is split across a process pool
+        (see learn_parallel), which is "pool" if given and a new one
+        otherwise.
+
+        The training text itself is not kept: only the counts, the set of
+        characters seen, and the first and last k characters, which are
+        what later calls to partial_fit need.
         '''
 
+        if alphabet is not None and not set(s) <= set(alphabet):
+            raise ValueError("alphabet does not cover the training text")
+        if backend not in BACKENDS:
+            raise ValueError("backend must be one of " + ", ".join(BACKENDS))
+
         self._k = k
-        self._s = s
-        self.k_table, self.k1_table = self.learn()
+        self._seen = set(s)
+        self._alphabet_size = len(self._seen)
+        self._fixed_alphabet = alphabet is not None
+        self.__set_alphabet(s if alphabet is None else alphabet)
+        self._requested_backend = backend
+        self._backend = self.__choose_backend(backend)
+        self._head = s[:k]
+        self._tail = s[max(len(s) - k, 0):]
+        if processes > 1:
+            self.k_table, self.k1_table = self.learn_parallel(s, processes,
+                                                              pool)
+        else:
+            self.k_table, self.k1_table = self.learn(s)
+
+    @classmethod
+    def from_chunks(cls, k, chunks, alphabet=None, backend="auto"):
+        '''
+        Train a k-order Markov model on the concatenation of the strings in
+        the iterable "chunks", one chunk at a time. The result is the same as
+        training on the whole text at once.
+        '''
+
+        model = cls(k, "", alphabet, backend)
+        for chunk in chunks:
+            model.partial_fit(chunk)
+
+        return model
+
+    @classmethod
+    def from_file(cls, k, path, alphabet=None, backend="auto",
+                  chunk_size=CHUNK_SIZE):
+        '''
+        Train a k-order Markov model on the text file "path", reading
+        "chunk_size" characters at a time
+        '''
+
+        with open(path, "r") as f:
+            chunks = iter(lambda: f.read(chunk_size), "")
+            return cls.from_chunks(k, chunks, alphabet, backend)
+
+    def partial_fit(self, chunk):
+        '''
+        Update the model as if "chunk" had been appended to its training
+        text.
+
+        The windows that start in the previous k-character tail and end in
+        "chunk" are added, and the k windows that wrap from the end of the
+        text back to its start are recounted against the new tail.
+        '''
+
+        if self._head is None:
+            raise ValueError("this model cannot be trained further")
+        if not chunk:
+            return
+
+        new_chars = set(chunk) - set(self._alphabet)
+        if new_chars and self._fixed_alphabet:
+            raise ValueError("alphabet does not cover the training text")
+        if new_chars:
+            self.__grow_alphabet(new_chars)
+        self._seen.update(chunk)
+        self._alphabet_size = len(self._seen)
+
+        k = self._k
+        old_wrap = self.ngram_codes(self._tail + self._head)
+        text = self._tail + chunk
+        added = self.ngram_codes(text)
+        self._head = (self._head + chunk[:k])[:k]
+        self._tail = text[max(len(text) - k, 0):]
+        new_wrap = self.ngram_codes(self._tail + self._head)
+
+        tables = (self.k_table, self.k1_table)
+        for i, table in enumerate(tables):
+            codes = np.concatenate([added[i], new_wrap[i], old_wrap[i]])
+            signs = np.ones(len(codes), dtype=np.int64)
+            signs[len(codes) - len(old_wrap[i]):] = -1
+            keys, inverse = np.unique(codes, return_inverse=True)
+            counts = np.zeros(len(keys), dtype=np.int64)
+            np.add.at(counts, inverse, signs)
+            changed = counts != 0
+            self.__add_counts(table, keys[changed], counts[changed])
+
+    def __add_counts(self, table, keys, counts):
+        '''
+        Add "counts" to the counts of the distinct codes "keys" in "table"
+        '''
+
+        if not isinstance(table, HashTable):
+            table.add(keys, counts)
+            return
+
+        for key, cnt in zip(keys.tolist(), counts.tolist()):
+            if table.increment(key, cnt) <= 0:
+                table.delete(key)
+
+    def __grow_alphabet(self, chars):
+        '''
+        Add "chars" to the alphabet and recode both count tables. Old
+        characters keep their relative order, so each code is rewritten
+        digit by digit and the tables stay sorted by code.
+        '''
+
+        old_alphabet = self._alphabet
+        old_base = self._base
+        old = [self.__table_arrays(table)
+               for table in (self.k_table, self.k1_table)]
+
+        self.__set_alphabet(old_alphabet + "".join(chars))
+        self._backend = self.__choose_backend(self._requested_backend)
+        remap = np.array([self._alphabet.index(c) for c in old_alphabet])
+
+        tables = []
+        for (keys, counts), length in zip(old, (self._k, self._k + 1)):
+            codes = np.zeros(len(keys), dtype=self._dtype)
+            scale = 1
+            for j in range(length):
+                digits = (keys % old_base).astype(np.int64)
+                keys = keys // old_base
+                codes = codes + remap[digits].astype(self._dtype) * scale
+                scale *= self._base
+            tables.append(self.__table_from_counts(codes, counts, length))
+        self.k_table, self.k1_table = tables
+
+    def __table_arrays(self, table):
+        '''
+        Return the codes (in ascending order) and counts of "table" as arrays
+        '''
+
+        if isinstance(table, SparseCounts):
+            return table.keys, table.counts
+
+        if isinstance(table, DenseCounts):
+            keys = np.flatnonzero(table.counts)
+            return keys, table.counts[keys]
+
+        items = sorted(table.items())
+        keys = np.array([key for key, cnt in items], dtype=self._dtype)
+        counts = np.array([cnt for key, cnt in items], dtype=np.int64)
+
+        return keys, counts
+
+    def __choose_backend(self, backend):
+        '''
+        Resolve "auto" and check that the backend can hold this model's codes
+        '''
+
+        cells = self._base ** (self._k + 1)
+
+        if backend == "auto":
+            if cells <= DENSE_MAX_CELLS:
+                return "dense"
+            if self._dtype is object:
+                return "hash"
+            return "sparse"
+
+        if backend != "hash" and self._dtype is object:
+            raise ValueError("sequence codes do not fit in 64 bits; "
+                             "use the hash backend")
+        if backend == "dense" and cells > DENSE_MAX_CELLS:
+            raise ValueError("code space too large for a dense table; "
+                             "use the sparse or hash backend")
+
+        return backend
+
+    def __set_alphabet(self, alphabet):
+        '''
+        Fix the character coding: the i-th character of the sorted alphabet
+        is coded i, and any other character is coded len(alphabet). A
+        sequence c_1 ... c_n is coded as the base-(len(alphabet) + 1) number
+        with digits c_1 ... c_n.
+        '''
+
+        self._alphabet = "".join(sorted(set(alphabet)))
+        self._points = np.array([ord(c) for c in self._alphabet],
+                                dtype=np.uint32)
+        self._base = len(self._alphabet) + 1
+        if self._base ** (self._k + 1) <= MAX_INT_CODE:
+            self._dtype = np.int64
+        else:
+            self._dtype = object
+
+    def encode(self, s):
+        '''
+        Return the array of character codes of string "s"
+        '''
+
+        points = np.frombuffer(s.encode("utf-32-le"), dtype=np.uint32)
+        idx = np.searchsorted(self._points, points)
+        known = idx < len(self._points)
+        known[known] = self._points[idx[known]] == points[known]
+        idx[~known] = len(self._points)
+
+        return idx.astype(self._dtype)
+
+    def decode(self, code, length):
+        '''
+        Return the character sequence of "length" characters coded as "code"
+        '''
+
+        chars = []
+        for i in range(length):
+            code, digit = divmod(code, self._base)
+            chars.append(self._alphabet[digit] if digit < len(self._alphabet)
+                         else "?")
+
+        return "".join(reversed(chars))
+
+    def save(self, path):
+        '''
+        Write the order, alphabet and both count tables to "path", in a
+        format that Markov.load can memory-map. The sequence codes must fit
+        in 64 bits, i.e. (len(alphabet) + 1) ** (k + 1) < 2 ** 63.
+        '''
+
+        if self._dtype is object:
+            raise ValueError("sequence codes do not fit in 64 bits; "
+                             "the model cannot be saved")
+
+        alphabet = self._alphabet.encode("utf-8")
+
+        with open(path, "wb") as f:
+            f.write(MARKOV_HEADER.pack(MARKOV_MAGIC, self._k,
+                                       self._alphabet_size, len(alphabet)))
+            f.write(alphabet + bytes(-len(alphabet) % 8))
+            write_table(f, self.k_table.items(), INT_KEYS)
+            write_table(f, self.k1_table.items(), INT_KEYS)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Memory-map a model written by Markov.save. The count tables become
+        sparse tables over the mapped pages, so loading is independent of the
+        model size and processes loading the same file share its pages.
+        '''
+
+        with open(path, "rb") as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, k, alphabet_size, length = MARKOV_HEADER.unpack_from(buf, 0)
+        if magic != MARKOV_MAGIC:
+            raise ValueError(path + " is not a saved Markov model")
+        start = MARKOV_HEADER.size
+
+        alphabet = buf[start:start + length].decode("utf-8")
+
+        k_table = MappedTable(buf, start + length + (-length % 8))
+        k1_table = MappedTable(buf, k_table.end)
+        tables = [SparseCounts(*[np.frombuffer(a, dtype=np.int64)
+                                 for a in table.int_arrays()])
+                  for table in (k_table, k1_table)]
+
+        return cls.from_tables(k, alphabet, alphabet_size, *tables)
+
+    @classmethod
+    def from_tables(cls, k, alphabet, alphabet_size, k_table, k1_table):
+        '''
+        Build a k-order model around count tables that were counted elsewhere
+        with this class's coding over "alphabet". "alphabet_size" is the
+        number of distinct characters in the training text. The model can
+        score text but cannot be trained further.
+        '''
+
+        model = cls.__new__(cls)
+        model._k = k
+        model._head = model._tail = None
+        model._alphabet_size = alphabet_size
+        model.__set_alphabet(alphabet)
+        model._backend = None
+        model.k_table, model.k1_table = k_table, k1_table
+
+        return model
 
     def get_k_k1(self, s):
         '''
-        Given a string, return two lists of strings, one is the list of all 
-        combination of consecutive k characters, while the other is the list 
-        of all combination of consecutive k+1 characters
+        Given a string, return two integer arrays, one is the codes of all
+        combination of consecutive k characters, while the other is the codes
+        of all combination of consecutive k+1 characters (the string wraps
+        around by k characters)
+
+        The codes are built with k+1 whole-array steps of a rolling
+        base-|alphabet| sum, so no substring is ever created.
         '''
 
-        s_ = s + s[:self._k]
-        k_str = []
-        k1_str = []
-        for i in range(self._k, len(s_)):
-            i_0 = s_[i - self._k:i]
-            i_1 = s_[i]
-            k_str.append(i_0)
-            k1_str.append(i_0 + i_1)
+        return self.ngram_codes(s + s[:self._k])
 
-        return k_str, k1_str
+    def ngram_codes(self, s):
+        '''
+        Like get_k_k1, but only for the windows that fit inside "s", without
+        wrapping around
+        '''
 
-    def learn(self):
+        idx = self.encode(s)
+
+        return self.__window_codes(idx, np.arange(max(len(idx) - self._k, 0)))
+
+    def __window_codes(self, idx, starts):
+        '''
+        Given the character codes "idx" and the array of window start
+        positions "starts", return the codes of the k and k+1 characters
+        starting at each position
+        '''
+
+        k_codes = np.zeros(len(starts), dtype=self._dtype)
+        for j in range(self._k):
+            k_codes = k_codes * self._base + idx[starts + j]
+        k1_codes = k_codes * self._base + idx[starts + self._k]
+
+        return k_codes, k1_codes
+
+    def learn(self, s):
         '''
-        Generate two hash tables for the k characters and k+1
-        characters, where the key is the string and the 
+        Generate two count tables for the k characters and k+1
+        characters of string "s", where the key is the sequence code and the
         value is the frequencies
         '''
 
-        k_hash = hash_table.HashTable(HASH_CELLS, None)
-        k1_hash = hash_table.HashTable(HASH_CELLS, None)
-        k_str, k1_str = self.get_k_k1(self._s)
+        k_codes, k1_codes = self.get_k_k1(s)
+
+        return (self.__count_table(k_codes, self._k),
+                self.__count_table(k1_codes, self._k + 1))
+
+    def learn_parallel(self, s, processes, pool=None):
+        '''
+        Same as learn, but the windows of the (wrapped) training text are
+        split into shards that are counted by a pool of "processes" workers:
+        "pool" if given (it is left open), a new one otherwise.
+        Each shard carries the k characters that follow it, so windows that
+        straddle a shard boundary are counted exactly once. The per-shard
+        counts are then merged.
+        '''
+
+        k = self._k
+        s_ = s + s[:k]
+        n = max(len(s_) - k, 0)
+        bounds = np.linspace(0, n, processes * SHARDS_PER_PROCESS + 1)
+        bounds = np.unique(bounds.astype(np.int64)).tolist()
+        if len(bounds) < 2:
+            return self.learn(s)
+        jobs = [(k, self._alphabet, s_[a:b + k])
+                for a, b in zip(bounds, bounds[1:])]
+
+        if pool is not None:
+            parts = pool.starmap(count_shard, jobs)
+        else:
+            with Pool(processes) as pool:
+                parts = pool.starmap(count_shard, jobs)
+
+        tables = []
+        for length, i in ((k, 0), (k + 1, 1)):
+            keys = np.concatenate([part[i][0] for part in parts])
+            counts = np.concatenate([part[i][1] for part in parts])
+            keys, inverse = np.unique(keys, return_inverse=True)
+            merged = np.zeros(len(keys), dtype=np.int64)
+            np.add.at(merged, inverse, counts)
+            tables.append(self.__table_from_counts(keys, merged, length))
+
+        return tuple(tables)
+
+    def __count_table(self, codes, length):
+        '''
+        Count the codes of "length"-character sequences in the backend's table
+        '''
+
+        return count_codes(codes, self._backend, self._base ** length)
+
+    def __table_from_counts(self, keys, counts, length):
+        '''
+        Build the backend's table from the sorted distinct codes "keys" of
+        "length"-character sequences and their "counts"
+        '''
+
+        if self._backend == "dense":
+            table = np.zeros(self._base ** length, dtype=np.int64)
+            table[keys] = counts
+            return DenseCounts(table)
+
+        if self._backend == "sparse":
+            return SparseCounts(keys, counts.astype(np.int64))
 
-        for i in range(len(k_str)):
+        table = HashTable(HASH_CELLS, 0, expected=len(keys))
+        table.update_many(zip(keys.tolist(), counts.tolist()))
 
-            k1_value = k1_hash.lookup(k1_str[i])
-            k_value = k_hash.lookup(k_str[i])
+        return table
+
+    def __counts(self, table, codes):
+        '''
+        Return the float array of the counts of "codes" in "table". Array
+        backends look all codes up at once; a HashTable is probed once per
+        distinct code.
+        '''
 
-            if not k1_value:
-                k1_hash.update(k1_str[i], 1)
-            else:
-                k1_hash.update(k1_str[i], k1_value + 1)
+        if not isinstance(table, HashTable):
+            return table.lookup_many(codes).astype(float)
 
-            if not k_value:
-                k_hash.update(k_str[i], 1)
-            else:
-                k_hash.update(k_str[i], k_value + 1)
+        keys, inverse = np.unique(codes, return_inverse=True)
+        counts = np.array(table.lookup_many(keys.tolist()), dtype=float)
 
-        return k_hash, k1_hash
+        return counts[inverse]
+
+    def prune(self, min_count):
+        '''
+        Forget every (k+1)-character sequence seen fewer than "min_count"
+        times. Return the number of sequences removed.
+        '''
+
+        return self.k1_table.delete_if(lambda cnt: cnt < min_count)
+
+    def most_common(self, n):
+        '''
+        Return the "n" most frequent (k+1)-character sequences as a list of
+        (sequence, count) pairs, most frequent first
+        '''
+
+        top = heapq.nlargest(n, self.k1_table.items(), key=lambda kv: kv[1])
+
+        return [(self.decode(code, self._k + 1), cnt) for code, cnt in top]
 
     def log_probability(self, s):
         '''
@@ -187,39 +1284,203 @@ class Markov:
         This probability is *not* normalized by the length of the string.
         '''
 
-        prob = 0
-        S = len(set(self._s))
-        k_str, k1_str = self.get_k_k1(s)
+        return self.score_codes(*self.get_k_k1(s))
+
+    def log_probabilities(self, s):
+        '''
+        Return the array of log probabilities of each character of the
+        wrapped string "s" (the (i+k)-th character, for i = 0, 1, ...) given
+        the k characters before it
+        '''
+
+        return self.__log_probs(*self.get_k_k1(s))
 
-        for i in range(len(k_str)):
+    def score_codes(self, k_codes, k1_codes):
+        '''
+        Get the (not normalized) log probability of a string from the codes
+        that get_k_k1 returned for it. Models with the same order and
+        alphabet produce the same codes, so one extraction can be scored
+        against many models.
+        '''
 
-            cnt = self.k1_table.lookup(k1_str[i])
-            tot = self.k_table.lookup(k_str[i])
-            if not cnt:
-                cnt = 0
-            if not tot:
-                tot = 0
-            prob += math.log((cnt + 1) / (tot + S))
+        return float(np.sum(self.__log_probs(k_codes, k1_codes)))
 
-        return prob
+    def __log_probs(self, k_codes, k1_codes):
+        '''
+        Return the array of log probabilities of each (k+1)-character
+        sequence given its first k characters
+        '''
 
+        S = self._alphabet_size
+        tot = self.__counts(self.k_table, k_codes)
+        cnt = self.__counts(self.k1_table, k1_codes)
 
-def identify_speaker(speaker_a, speaker_b, unknown_speech, k):
+        return np.log((cnt + 1) / (tot + S))
+
+    def score_many(self, texts):
+        '''
+        Return an array with the log probability of every string in "texts",
+        *normalized* by its length (nan for an empty string).
+
+        All texts are encoded as one string and their windows are looked up
+        in one batch, so the per-call overhead is paid once per batch.
+        '''
+
+        k = self._k
+        texts = list(texts)
+        wrapped = [t + t[:k] for t in texts]
+        lengths = np.array([len(t) for t in texts], dtype=float)
+        sizes = np.array([len(w) for w in wrapped], dtype=np.int64)
+        windows = np.maximum(sizes - k, 0)
+
+        # window starts, skipping the last k positions of every text so that
+        # no window crosses into the next one
+        offsets = np.cumsum(sizes) - sizes
+        first = np.cumsum(windows) - windows
+        owner = np.repeat(np.arange(len(texts)), windows)
+        starts = np.arange(windows.sum()) + np.repeat(offsets - first, windows)
+
+        idx = self.encode("".join(wrapped))
+        k_codes, k1_codes = self.__window_codes(idx, starts)
+        probs = np.bincount(owner, weights=self.__log_probs(k_codes, k1_codes),
+                            minlength=len(texts))
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return np.where(lengths > 0, probs / lengths, np.nan)
+
+
+class MultiOrderMarkov:
+
+    def __init__(self, max_k, s, alphabet=None, backend="auto"):
+        '''
+        Construct Markov models of every order 0 .. max_k from string "s" in
+        one pass. The codes of the sequences of length j are computed from
+        those of length j - 1 with one array step, and each count table is
+        shared by the two orders that use it (as the k+1 table of order
+        j - 1 and the k table of order j).
+
+        Every order gives exactly the counts of Markov(k, s). "s" must have
+        at least max_k characters, so that every order wraps around it the
+        same way.
+        '''
+
+        if len(s) < max_k:
+            raise ValueError("the training text is shorter than max_k")
+        if backend not in BACKENDS:
+            raise ValueError("backend must be one of " + ", ".join(BACKENDS))
+
+        self._max_k = max_k
+        alphabet = s if alphabet is None else alphabet
+        coder = Markov(max_k, "", alphabet, backend="hash")
+        base = coder._base
+        idx = coder.encode(s + s[:max_k])
+        n = len(s)
+
+        tables = []
+        codes = np.zeros(n, dtype=np.int64)
+        for length in range(max_k + 2):
+            if length > 0:
+                if base ** length > MAX_INT_CODE and codes.dtype != object:
+                    codes = codes.astype(object)
+                    idx = idx.astype(object)
+                codes = codes * base + idx[length - 1:length - 1 + n]
+            table_backend = self.__choose_backend(backend, base, length)
+            tables.append(count_codes(codes, table_backend, base ** length))
+
+        self._models = [Markov.from_tables(k, alphabet, len(set(s)),
+                                           tables[k], tables[k + 1])
+                        for k in range(max_k + 1)]
+
+    def __choose_backend(self, backend, base, length):
+        '''
+        Pick the backend of the table of "length"-character sequences. The
+        same rules as Markov apply, judged by the codes of the orders that
+        query the table (up to length + 1 characters).
+        '''
+
+        widest = base ** (min(length, self._max_k) + 1)
+
+        if backend == "auto":
+            if base ** length <= DENSE_MAX_CELLS:
+                return "dense"
+            if widest > MAX_INT_CODE:
+                return "hash"
+            return "sparse"
+
+        if backend == "sparse" and widest > MAX_INT_CODE:
+            raise ValueError("sequence codes do not fit in 64 bits; "
+                             "use the hash backend")
+        if backend == "dense" and base ** length > DENSE_MAX_CELLS:
+            raise ValueError("code space too large for a dense table; "
+                             "use the sparse or hash backend")
+
+        return backend
+
+    def model(self, k):
+        '''
+        Return the k-order Markov model (0 <= k <= max_k)
+        '''
+
+        return self._models[k]
+
+    def log_probability(self, s, k=None, weights=None):
+        '''
+        Get the (not normalized) log probability of string "s".
+
+        With "k", score it under the k-order model alone (the default is
+        max_k). With "weights", a sequence of max_k + 1 non-negative weights
+        summing to 1, every character is instead given the interpolated
+        probability sum(weights[k] * P_k) over the orders k = 0 .. max_k.
+        Interpolation needs "s" to have at least max_k characters.
+        '''
+
+        if weights is None:
+            return self.model(self._max_k if k is None else k) \
+                .log_probability(s)
+
+        if len(weights) != self._max_k + 1:
+            raise ValueError("need one weight per order 0 .. max_k")
+        if len(s) < self._max_k:
+            raise ValueError("the text is shorter than max_k")
+
+        # order k scores the character k places after each window start, so
+        # rolling by k lines every order up on the same character
+        mixed = np.zeros(len(s))
+        for k, weight in enumerate(weights):
+            if weight:
+                probs = np.exp(self._models[k].log_probabilities(s))
+                mixed += weight * np.roll(probs, k)
+
+        return float(np.sum(np.log(mixed)))
+
+
+def count_shard(k, alphabet, text):
     '''
-    Given sample text from two speakers, and text from an unidentified speaker,
-    return a tuple with the *normalized* log probabilities of each of the
-    speakers uttering that text under a "k" order character-based Markov model,
-    and a conclusion of which speaker uttered the unidentified text
-    based on the two probabilities.
+    Worker for Markov.learn_parallel: count the k and k+1 character windows
+    that fit inside "text". Returns ((k codes, counts), (k+1 codes, counts)).
     '''
 
-    model_a = Markov(k, speaker_a)
-    model_b = Markov(k, speaker_b)
+    # an untrained model, used only for its character coding
+    coder = Markov(k, "", alphabet, backend="hash")
+    k_codes, k1_codes = coder.ngram_codes(text)
+
+    return (np.unique(k_codes, return_counts=True),
+            np.unique(k1_codes, return_counts=True))
 
-    likelihood_a = model_a.log_probability(
-        unknown_speech) / len(unknown_speech)
-    likelihood_b = model_b.log_probability(
-        unknown_speech) / len(unknown_speech)
+
+def identify_speaker(speaker_a, speaker_b, unknown_speech, k):
+    '''
+    Given sample text (or trained models) from two speakers, and text from an
+    unidentified speaker, return a tuple with the *normalized* log
+    probabilities of each of the speakers uttering that text under a "k"
+    order character-based Markov model, and a conclusion of which speaker
+    uttered the unidentified text based on the two probabilities.
+    '''
+
+    ranking = dict(identify_speakers({"A": speaker_a, "B": speaker_b},
+                                     unknown_speech, k))
+    likelihood_a = ranking["A"]
+    likelihood_b = ranking["B"]
 
     if likelihood_a > likelihood_b:
         conclusion = "A"
@@ -229,6 +1490,56 @@ def identify_speaker(speaker_a, speaker_b, unknown_speech, k):
     return likelihood_a, likelihood_b, conclusion
 
 
+def identify_speakers(models_or_texts, unknown_speech, k, top=None,
+                      processes=1):
+    '''
+    Rank candidate speakers by the *normalized* log probability of them
+    uttering "unknown_speech".
+
+    "models_or_texts" is a dictionary from speaker name to either sample
+    text or a trained Markov model (or a list, in which case the names are
+    the positions). Sample texts are turned into "k" order models over one
+    shared alphabet, all trained by one pool of "processes" workers; models
+    keep their own order. The unknown text is encoded once per distinct
+    (order, alphabet) pair and those codes are scored against every model
+    that shares them.
+
+    Returns a list of (name, likelihood) pairs, most likely first, limited
+    to the "top" best if given.
+    '''
+
+    if not isinstance(models_or_texts, dict):
+        models_or_texts = dict(enumerate(models_or_texts))
+
+    texts = [s for s in models_or_texts.values() if isinstance(s, str)]
+    alphabet = "".join(set().union(*texts))
+    if processes > 1 and texts:
+        with Pool(processes) as pool:
+            models = {name: s if isinstance(s, Markov)
+                      else Markov(k, s, alphabet, processes=processes,
+                                  pool=pool)
+                      for name, s in models_or_texts.items()}
+    else:
+        models = {name: s if isinstance(s, Markov) else Markov(k, s, alphabet)
+                  for name, s in models_or_texts.items()}
+
+    extracted = {}
+    names = list(models)
+    likelihoods = np.empty(len(names))
+    for i, name in enumerate(names):
+        model = models[name]
+        shape = (model._k, model._alphabet)
+        if shape not in extracted:
+            extracted[shape] = model.get_k_k1(unknown_speech)
+        likelihoods[i] = model.score_codes(*extracted[shape])
+    likelihoods /= len(unknown_speech)
+
+    # stable sort, so ties keep the order in which speakers were given
+    order = np.argsort(-likelihoods, kind="stable")[:top]
+
+    return [(names[i], float(likelihoods[i])) for i in order]
+
+
 def print_results(res_tuple):
     '''
     Given a tuple from identify_speaker, print formatted results to the screen
@@ -257,16 +1568,17 @@ def go():
               "<order>")
         sys.exit(0)
 
-    with open(sys.argv[1], "r") as file1:
-        speech1 = file1.read()
+    k = int(sys.argv[4])
 
-    with open(sys.argv[2], "r") as file2:
-        speech2 = file2.read()
+    # the speaker models are trained from the files chunk by chunk, so the
+    # sample texts are never held in memory in full
+    model1 = Markov.from_file(k, sys.argv[1])
+    model2 = Markov.from_file(k, sys.argv[2])
 
     with open(sys.argv[3], "r") as file3:
         speech3 = file3.read()
 
-    res_tuple = identify_speaker(speech1, speech2, speech3, int(sys.argv[4]))
+    res_tuple = identify_speaker(model1, model2, speech3, k)
 
     print_results(res_tuple)
 
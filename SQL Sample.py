@@ -5,22 +5,198 @@ Zhen Yuan
 '''
 
 from math import radians, cos, sin, asin, sqrt, ceil
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from collections import OrderedDict
+import itertools
+import threading
+import asyncio
 import sqlite3
+import atexit
+import queue
+import hashlib
+import time
 import os
+import urllib.request
+
+import numpy as np
 
 
 # Use this filename for the database
 DATA_DIR = os.path.dirname(__file__)
 DATABASE_FILENAME = os.path.join(DATA_DIR, 'course_information.sqlite3')
 
+# Most connections a pool keeps open to one database file
+POOL_SIZE = 8
+# Most distinct query shapes whose SQL text is kept
+QUERY_CACHE_SIZE = 256
+# Side of a building grid cell in degrees (about 1 km of latitude)
+GRID_CELL_DEGREES = 0.01
+# Earth radius and walking speed of haversine and compute_time_between
+EARTH_RADIUS_KM = 6367
+WALK_SPEED_M_PER_SEC = 1.1
+# Answer "terms" criteria from an in-memory inverted index of catalog_index
+# instead of grouping catalog_index rows in SQL
+USE_TERM_INDEX = True
+# Most find_courses results kept, and for how many seconds
+RESULT_CACHE_SIZE = 1024
+RESULT_CACHE_TTL = 300
+# Rows fetched at a time by iter_courses, and rows per page by default
+STREAM_BATCH_SIZE = 500
+PAGE_SIZE = 50
+# Most criteria dicts run by one task of find_courses_many
+BATCH_CHUNK_SIZE = 64
+# SQLite instructions between checks for a cancelled async query
+PROGRESS_INSTRUCTIONS = 1000
+
+# Indexes the course search queries can use, as (name, table, columns).
+# The advisor creates the ones whose table a query plan scans in full.
+SEARCH_INDEXES = [
+    ("catalog_index_word", "catalog_index", ("word", "course_id")),
+    ("catalog_index_course", "catalog_index", ("course_id",)),
+    ("sections_course", "sections", ("course_id", "meeting_pattern_id")),
+    ("sections_meeting_pattern", "sections", ("meeting_pattern_id",)),
+    ("sections_enrollment", "sections", ("enrollment",)),
+    ("meeting_patterns_day", "meeting_patterns",
+     ("day", "time_start", "time_end")),
+    ("courses_dept", "courses", ("dept",)),
+]
+
+
+class CourseConnection(sqlite3.Connection):
+    '''
+    A connection that remembers which version of the database it last
+    checked each shared snapshot against (see shared_snapshot), and which
+    TEMP tables it has created
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.snapshot_versions = {}
+        self.temp_tables = set()
+
+
+class ConnectionPool:
+    '''
+    A thread-safe pool of connections to one database file. Connections are
+    opened lazily, up to "size" of them, with the time_between function
+    already registered, and are handed to one thread at a time. Connections
+    of a "readonly" pool cannot change the database (TEMP tables still work).
+    '''
+
+    def __init__(self, filename, size=POOL_SIZE, readonly=False):
+        self.filename = filename
+        self.size = size
+        self.readonly = readonly
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        '''
+        Open a new connection and register the UDFs the queries use
+        '''
+        if self.readonly:
+            uri = "file:{}?mode=ro".format(
+                urllib.request.pathname2url(os.path.abspath(self.filename)))
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False,
+                                   factory=CourseConnection,
+                                   cached_statements=QUERY_CACHE_SIZE)
+        else:
+            conn = sqlite3.connect(self.filename, check_same_thread=False,
+                                   factory=CourseConnection,
+                                   cached_statements=QUERY_CACHE_SIZE)
+        conn.create_function("time_between", 4, compute_time_between)
+        conn.create_aggregate("table_digest", -1, TableDigest)
+        return conn
+
+    def acquire(self):
+        '''
+        Take an idle connection, opening a new one if the pool is not full,
+        or wait for one to be released
+        '''
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._opened < self.size:
+                self._opened += 1
+                return self._connect()
+        return self._idle.get()
+
+    def release(self, conn):
+        '''
+        Give a connection back to the pool
+        '''
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        '''
+        Context manager lending a connection for the duration of a block
+        '''
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        '''
+        Close the idle connections
+        '''
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._opened -= 1
+
 
-def select_from_str(args_from_ui):
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(filename=None, readonly=False, size=POOL_SIZE):
+    '''
+    Return the shared connection pool for a database file (by default
+    DATABASE_FILENAME), creating it on first use, with room for at least
+    "size" connections
+    '''
+    filename = filename or DATABASE_FILENAME
+    with _pools_lock:
+        if (filename, readonly) not in _pools:
+            _pools[(filename, readonly)] = ConnectionPool(filename, size,
+                                                          readonly)
+        pool = _pools[(filename, readonly)]
+        pool.size = max(pool.size, size)
+        return pool
+
+
+@atexit.register
+def close_pools():
+    '''
+    Close every pooled connection
+    '''
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+
+def select_from_str(args_from_ui, term_index=False):
     '''
     Takes a dictionary containing search criteria and returns a
     string of SQL code of SELECT, FROM and ON parts
 
     Input:
         args_from_ui: a dictionary containing search criteria
+        term_index: whether the courses matching the terms are already in
+                    the TEMP table term_matches (see fill_term_matches), in
+                    which case where_str selects them
     Output:
         se_str: SQL query in which parameters are specified with question marks (?)
                 of SELECT, FROM and ON parts
@@ -30,7 +206,7 @@ def select_from_str(args_from_ui):
     from_str = " FROM courses"
     on_lst = []
     on_str = ""
-    if "terms" in args_from_ui:
+    if "terms" in args_from_ui and not term_index:
         from_str += " JOIN (SELECT catalog_index.course_id AS id FROM catalog_index WHERE word"\
                     " IN (?" + ", ?"* (len(args_from_ui["terms"])-1) + ") GROUP BY catalog_index.course_id"\
                     " HAVING COUNT(course_id) = ?)"
@@ -49,10 +225,9 @@ def select_from_str(args_from_ui):
     if "building_code" in args_from_ui:
 
         select_str += ", sections.building_code, walking_time"
-        # Subquery is needed to create a new table
-        from_str += " JOIN (SELECT a.building_code, b.building_code AS building,"\
-                    " time_between(a.lon, a.lat, b.lon, b.lat) AS walking_time FROM"\
-                    " (SELECT * FROM gps WHERE building_code = ?) AS a JOIN gps AS b)"
+        # buildings near the origin, filled in by fill_walk_candidates
+        from_str += " JOIN (SELECT rowid AS walk_key, building_b AS building,"\
+                    " walking_time FROM walk_candidates WHERE building_a = ?)"
         on_lst.append("sections.building_code = building")    
 
     # If mutiple tables
@@ -63,7 +238,7 @@ def select_from_str(args_from_ui):
     
     return se_str
 
-def where_str(args_from_ui):
+def where_str(args_from_ui, term_index=False):
     '''
     Takes a dictionary containing search criteria and returns a
     string of SQL query in which parameters are specified with question marks (?)
@@ -71,6 +246,8 @@ def where_str(args_from_ui):
 
     Input:
         args_from_ui: a dictionary containing search criteria
+        term_index: whether the terms are matched by the term index, so that
+                    they need no parameters
 
     Output:
         wh_str: SQL query in which parameters are specified with question marks (?)
@@ -82,7 +259,10 @@ def where_str(args_from_ui):
     args = []
     wh_str = ""
     # append the WHERE part of query and list of parameters in a certain order
-    if "terms" in args_from_ui:
+    if "terms" in args_from_ui and term_index:
+        # as an IN list, so that the matches drive the query
+        wh_lst.append("courses.course_id IN (SELECT id FROM term_matches)")
+    elif "terms" in args_from_ui:
         for word in args_from_ui["terms"]:
             args.append(word)
         args.append(len(args_from_ui["terms"]))
@@ -117,6 +297,626 @@ def where_str(args_from_ui):
     return wh_str, tuple_args
 
 
+def haversine_array(lon1, lat1, lon2, lat2):
+    '''
+    Array version of haversine: the arguments are arrays (or scalars) of
+    decimal degrees that broadcast against each other, and the result is
+    the array of circle distances in meters, computed exactly as haversine
+    does for each pair
+    '''
+    # convert decimal degrees to radians
+    lon1, lat1, lon2, lat2 = [np.radians(np.asarray(x, dtype=float))
+                              for x in (lon1, lat1, lon2, lat2)]
+
+    # haversine formula
+    dlon = lon2 - lon1
+    dlat = lat2 - lat1
+    a = np.sin(dlat / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2)**2
+    c = 2 * np.arcsin(np.sqrt(a))
+
+    km = EARTH_RADIUS_KM * c
+    m = km * 1000
+    return m
+
+
+def compute_time_between_array(lon1, lat1, lon2, lat2):
+    '''
+    Array version of compute_time_between: walking times in minutes for
+    broadcast arrays of coordinates, with the same speed and rounding
+    '''
+    meters = haversine_array(lon1, lat1, lon2, lat2)
+
+    mins = meters / (WALK_SPEED_M_PER_SEC * 60)
+
+    return np.ceil(mins).astype(np.int64)
+
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+class TableDigest:
+    '''
+    SQL aggregate table_digest(column, ...): a fixed-size digest of the rows
+    it is given, computed row by row so that no table-sized value is built
+    '''
+
+    def __init__(self):
+        self.digest = hashlib.blake2b(digest_size=16)
+
+    def step(self, *values):
+        self.digest.update(repr(values).encode("utf-8"))
+
+    def finalize(self):
+        return self.digest.hexdigest()
+
+
+def install_change_tracking(filename=None, tables=("gps", "catalog_index")):
+    '''
+    Adds a change_versions(name, version) table to a database file, with
+    triggers that bump the version of each of "tables" on every INSERT,
+    UPDATE and DELETE. Once installed, the shared snapshots built from those
+    tables check one row instead of digesting the whole table.
+
+    Input:
+        filename: the database file, DATABASE_FILENAME by default
+        tables: the tables to track
+    '''
+    with get_pool(filename).connection() as conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS change_versions"
+                     " (name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+        for table in tables:
+            conn.execute("INSERT OR IGNORE INTO change_versions VALUES (?, 0)",
+                         (table,))
+            for event in ("INSERT", "UPDATE", "DELETE"):
+                conn.execute(
+                    "CREATE TRIGGER IF NOT EXISTS {0}_{1}_version AFTER {2}"
+                    " ON {0} BEGIN UPDATE change_versions"
+                    " SET version = version + 1 WHERE name = '{0}'; END"
+                    .format(table, event.lower(), event))
+        conn.commit()
+
+
+def table_fingerprint(conn, table, columns):
+    '''
+    Returns a value that changes whenever a table changes: its version in
+    change_versions if install_change_tracking was run, and otherwise its
+    row count and a table_digest of "columns"
+    '''
+    try:
+        row = conn.execute("SELECT version FROM change_versions"
+                           " WHERE name = ?", (table,)).fetchone()
+    except sqlite3.OperationalError:
+        # no change_versions table
+        row = None
+    if row is not None:
+        return ("version", row[0])
+    return tuple(conn.execute("SELECT count(*), table_digest({}) FROM {}"
+                              .format(columns, table)).fetchone())
+
+
+_snapshots = {}
+_snapshots_lock = threading.Lock()
+
+
+def shared_snapshot(conn, filename, table, columns, build):
+    '''
+    Returns an object built from a table by build(conn), shared by every
+    connection to the file. The connection checks the table's fingerprint
+    (see table_fingerprint) only when PRAGMA data_version says another
+    connection has committed since its last check, and the object is
+    rebuilt only when the fingerprint has changed.
+
+    Input:
+        conn: a CourseConnection to the file
+        filename: the database file
+        table: the table the object is built from
+        columns: the columns of the table it depends on, comma separated
+        build: a function of a connection returning the object
+    Output:
+        the object
+    '''
+    # data_version changes whenever another connection commits a change
+    version = conn.execute("PRAGMA data_version").fetchone()[0]
+    snapshot = _snapshots.get((filename, table))
+    if snapshot is not None and conn.snapshot_versions.get(table) == version:
+        return snapshot[1]
+
+    fingerprint = table_fingerprint(conn, table, columns)
+    with _snapshots_lock:
+        snapshot = _snapshots.get((filename, table))
+        if snapshot is None or snapshot[0] != fingerprint:
+            snapshot = (fingerprint, build(conn))
+            _snapshots[(filename, table)] = snapshot
+    conn.snapshot_versions[table] = version
+    return snapshot[1]
+
+
+def ensure_temp_table(conn, name, columns):
+    '''
+    Creates a TEMP table on the connection unless it already has it
+    '''
+    if name not in conn.temp_tables:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS {} ({})"
+                     .format(name, columns))
+        conn.temp_tables.add(name)
+
+
+class BuildingGrid:
+    '''
+    A uniform lon/lat grid over the rows of the gps table, so that the
+    buildings within a walking time of an origin are found by looking at
+    the few grid cells around it instead of at every building
+    '''
+
+    def __init__(self, rows, cell=GRID_CELL_DEGREES):
+        self.cell = cell
+        self.codes = [r[0] for r in rows]
+        self.lon = np.array([r[1] for r in rows], dtype=float)
+        self.lat = np.array([r[2] for r in rows], dtype=float)
+        self.origins = {}
+        self.cells = {}
+        for i, code in enumerate(self.codes):
+            self.origins.setdefault(code, []).append(i)
+        ix = np.floor(self.lon / cell).astype(np.int64).tolist()
+        iy = np.floor(self.lat / cell).astype(np.int64).tolist()
+        for i, key in enumerate(zip(ix, iy)):
+            self.cells.setdefault(key, []).append(i)
+
+    def candidates(self, lon0, lat0, walking_time):
+        '''
+        Return the indices of the buildings in the grid cells overlapping the
+        bounding box of every point within "walking_time" minutes of
+        (lon0, lat0). This is a superset of the buildings in range.
+        '''
+        everything = np.arange(len(self.codes))
+        # ceil(meters / speed) <= walking_time exactly when
+        # meters <= walking_time * speed, so this radius is tight;
+        # a little slack keeps rounding from dropping a building on the edge
+        angle = walking_time * WALK_SPEED_M_PER_SEC * 60 / \
+            (EARTH_RADIUS_KM * 1000)
+        angle = angle * (1 + 1e-9) + 1e-12
+        cos_lat = np.cos(np.radians(lat0))
+        if angle >= np.pi / 2 or np.sin(angle) >= cos_lat:
+            # the circle reaches a pole
+            return everything
+        dlat = np.degrees(angle)
+        # widest longitude span of the circle around lat0
+        dlon = np.degrees(np.arcsin(np.sin(angle) / cos_lat)) * (1 + 1e-9)
+        if lon0 - dlon < -180 or lon0 + dlon > 180:
+            # the box crosses the antimeridian
+            return everything
+
+        x0 = int(np.floor((lon0 - dlon) / self.cell))
+        x1 = int(np.floor((lon0 + dlon) / self.cell))
+        y0 = int(np.floor((lat0 - dlat) / self.cell))
+        y1 = int(np.floor((lat0 + dlat) / self.cell))
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self.cells):
+            # fewer occupied cells than cells in the box
+            found = [i for (x, y), lst in self.cells.items()
+                     if x0 <= x <= x1 and y0 <= y <= y1 for i in lst]
+        else:
+            found = [i for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)
+                     for i in self.cells.get((x, y), ())]
+        return np.array(sorted(found), dtype=np.int64)
+
+    def within(self, building_code, walking_time):
+        '''
+        Takes a building code and a number of minutes and returns an
+        (origin, building, walking time) triple for every building within that
+        walking time of a gps row of the origin, with times computed exactly
+        as compute_time_between does
+        '''
+        out = []
+        if walking_time < 0:
+            return out
+        for i in self.origins.get(building_code, ()):
+            near = self.candidates(self.lon[i], self.lat[i], walking_time)
+            times = compute_time_between_array(self.lon[i], self.lat[i],
+                                               self.lon[near], self.lat[near])
+            keep = times <= walking_time
+            out.extend((building_code, self.codes[j], t) for j, t in
+                       zip(near[keep].tolist(), times[keep].tolist()))
+        return out
+
+
+def ensure_building_grid(conn, filename):
+    '''
+    Returns the shared BuildingGrid over the gps table of a database file,
+    rebuilt when gps changes, and makes sure the connection has the TEMP
+    table walk_candidates(building_a, building_b, walking_time) that
+    fill_walk_candidates writes to
+
+    Input:
+        conn: a CourseConnection to the file
+        filename: the database file
+    Output:
+        the BuildingGrid
+    '''
+    ensure_temp_table(conn, "walk_candidates",
+                      "building_a TEXT, building_b TEXT, walking_time INTEGER")
+    return shared_snapshot(
+        conn, filename, "gps", "building_code, lon, lat",
+        lambda c: BuildingGrid(
+            c.execute("SELECT building_code, lon, lat FROM gps").fetchall()))
+
+
+def fill_walk_candidates(conn, filename, building_code, walking_time):
+    '''
+    Replaces the contents of the connection's walk_candidates table with
+    the buildings within "walking_time" minutes of "building_code"
+
+    Input:
+        conn: a CourseConnection
+        filename: the database file
+        building_code: a string
+        walking_time: an integer number of minutes
+    '''
+    grid = ensure_building_grid(conn, filename)
+    conn.execute("DELETE FROM temp.walk_candidates")
+    conn.executemany("INSERT INTO temp.walk_candidates VALUES (?, ?, ?)",
+                     grid.within(building_code, walking_time))
+    conn.commit()
+
+
+def buildings_within(building_code, walking_time):
+    '''
+    Takes a building code and a number of minutes and returns the buildings
+    within that walking time of it, nearest first
+
+    Input:
+        building_code: a string
+        walking_time: an integer number of minutes
+    Output:
+        a list of (building_code, walking_time) pairs
+    '''
+    pool = get_pool()
+    with pool.connection() as conn:
+        grid = ensure_building_grid(conn, pool.filename)
+    found = grid.within(building_code, walking_time)
+    return [(b, t) for a, b, t in sorted(found, key=lambda x: x[2])]
+
+
+class TermIndex:
+    '''
+    An inverted index of the catalog_index table: for every word, the sorted
+    array of the ids of the courses it describes
+    '''
+
+    def __init__(self, rows):
+        postings = {}
+        for course_id, word in rows:
+            postings.setdefault(word, []).append(course_id)
+        # the SQL counts catalog_index rows, which is the same as
+        # intersecting the postings only when ids are integers and no
+        # (course, word) pair is repeated
+        self.usable = all(isinstance(course_id, int) for course_id, word in rows)
+        self.postings = {}
+        for word, ids in postings.items():
+            ids = np.array(ids if self.usable else [], dtype=np.int64)
+            unique = np.unique(ids)
+            self.usable = self.usable and len(unique) == len(ids)
+            self.postings[word] = unique
+
+    def match(self, terms):
+        '''
+        Returns the sorted array of the ids of the courses described by
+        every word in "terms", intersecting the shortest postings first
+        '''
+        empty = np.empty(0, dtype=np.int64)
+        lists = sorted((self.postings.get(word, empty) for word in terms),
+                       key=len)
+        ids = lists[0]
+        for other in lists[1:]:
+            if not len(ids):
+                break
+            ids = np.intersect1d(ids, other, assume_unique=True)
+        return ids
+
+
+def ensure_term_index(conn, filename):
+    '''
+    Returns the shared TermIndex of a database file, rebuilt when
+    catalog_index changes, and makes sure the connection has the TEMP table
+    term_matches(id) that fill_term_matches writes to
+
+    Input:
+        conn: a CourseConnection to the file
+        filename: the database file
+    Output:
+        the TermIndex
+    '''
+    ensure_temp_table(conn, "term_matches", "id INTEGER PRIMARY KEY")
+    return shared_snapshot(
+        conn, filename, "catalog_index", "course_id, word",
+        lambda c: TermIndex(
+            c.execute("SELECT course_id, word FROM catalog_index").fetchall()))
+
+
+def fill_term_matches(conn, filename, terms):
+    '''
+    Replaces the contents of the connection's term_matches table with the
+    courses matching every word in "terms", if the term index can answer
+    the query exactly
+
+    Input:
+        conn: a CourseConnection
+        filename: the database file
+        terms: a list of strings
+    Output:
+        True if term_matches was filled, False if the query must group
+        catalog_index rows in SQL instead
+    '''
+    index = ensure_term_index(conn, filename)
+    # a repeated word never matches in SQL (its count is too small)
+    if not index.usable or len(set(terms)) != len(terms):
+        return False
+    conn.execute("DELETE FROM temp.term_matches")
+    conn.executemany("INSERT INTO temp.term_matches VALUES (?)",
+                     ((i,) for i in index.match(terms).tolist()))
+    conn.commit()
+    return True
+
+
+def criteria_shape(args_from_ui):
+    '''
+    Takes a dictionary containing search criteria and returns its shape:
+    which criteria are present and how many values each list holds. Criteria
+    with the same shape produce the same SQL string.
+
+    Input:
+        args_from_ui: a dictionary containing search criteria
+    Output:
+        a sorted tuple of (criterion, list length or None) pairs
+    '''
+    return tuple(sorted((key, len(val) if isinstance(val, (list, tuple)) else None)
+                        for key, val in args_from_ui.items()))
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def query_for_shape(shape, term_index=False):
+    '''
+    Takes a shape from criteria_shape and returns the full SQL query for it,
+    built once per shape by select_from_str and where_str
+
+    Input:
+        shape: a tuple from criteria_shape
+        term_index: as for select_from_str
+    Output:
+        q: SQL query in which parameters are specified with question marks (?)
+    '''
+    # the strings only depend on which criteria are present and list lengths
+    template = {key: [None] * n if n is not None else None for key, n in shape}
+    return select_from_str(template, term_index) + \
+        where_str(template, term_index)[0]
+
+
+def all_shapes():
+    '''
+    Returns one shape (as from criteria_shape) for every combination of
+    criteria find_courses accepts. List lengths are 1 for every list, since
+    they only change the number of placeholders, not the query plan.
+    '''
+    groups = [(("dept", None),), (("terms", 1),), (("day", 1),),
+              (("enrollment", 2),), (("time_start", None),),
+              (("time_end", None),),
+              (("building_code", None), ("walking_time", None))]
+    shapes = []
+    for n in range(1, len(groups) + 1):
+        for combo in itertools.combinations(groups, n):
+            shapes.append(tuple(sorted(itertools.chain(*combo))))
+    return shapes
+
+
+def explain_shape(conn, shape, term_index=False):
+    '''
+    Takes a connection and a shape and returns the EXPLAIN QUERY PLAN detail
+    lines of the shape's query
+
+    Input:
+        conn: a CourseConnection
+        shape: a tuple from criteria_shape
+        term_index: as for query_for_shape
+    Output:
+        a list of strings
+    '''
+    q = query_for_shape(shape, term_index)
+    # every placeholder gets a NULL: the plan does not depend on the values
+    args = (None,) * q.count("?")
+    return [r[3] for r in conn.execute("EXPLAIN QUERY PLAN " + q, args)]
+
+
+def full_scans(plan):
+    '''
+    Takes plan detail lines from explain_shape and returns the tables of the
+    database (not TEMP tables or subqueries) that the plan reads in full
+    '''
+    tables = set(table for name, table, columns in SEARCH_INDEXES)
+    scanned = []
+    for detail in plan:
+        words = detail.split()
+        # SQLite before 3.36 writes "SCAN TABLE courses"
+        if words[1:2] == ["TABLE"]:
+            words = words[:1] + words[2:]
+        if len(words) >= 2 and words[0] == "SCAN" and words[1] in tables \
+                and "INDEX" not in words:
+            scanned.append(words[1])
+    return scanned
+
+
+def existing_indexes(conn, table):
+    '''
+    Returns the column tuples of every index on a table
+    '''
+    out = []
+    for row in conn.execute("PRAGMA index_list({})".format(table)).fetchall():
+        info = conn.execute("PRAGMA index_info({})".format(row[1])).fetchall()
+        out.append(tuple(r[2] for r in sorted(info)))
+    return out
+
+
+def advise_indexes(filename=None, create=True):
+    '''
+    Checks the query plan of every query shape find_courses can produce,
+    creates the indexes from SEARCH_INDEXES that are missing on tables some
+    plan scans in full (unless "create" is False), and reports what still
+    falls back to full scans
+
+    Input:
+        filename: the database file, DATABASE_FILENAME by default
+        create: whether to create the missing indexes
+    Output:
+        a dictionary with
+          - "missing": names of the suggested indexes that did not exist
+          - "created": names of the indexes created
+          - "scans": {shape: tables still scanned in full} for the shapes
+            whose plans scan a table
+    '''
+    pool = get_pool(filename)
+    with pool.connection() as conn:
+        # walking-time shapes join the per-connection candidates table
+        ensure_building_grid(conn, pool.filename)
+        # plan terms shapes in the form prepare_query runs them in
+        term_index = USE_TERM_INDEX and \
+            ensure_term_index(conn, pool.filename).usable
+        shapes = all_shapes()
+
+        missing = []
+        for name, table, columns in SEARCH_INDEXES:
+            have = existing_indexes(conn, table)
+            # an index whose leading columns match serves just as well
+            if not any(cols[:len(columns)] == columns for cols in have):
+                missing.append((name, table, columns))
+        created = []
+        while create:
+            scanned = set()
+            for shape in shapes:
+                scanned.update(full_scans(explain_shape(conn, shape,
+                                                        term_index)))
+            # an index can change the join order so that another table is
+            # scanned, so repeat until no plan asks for a new index
+            todo = [(name, table, columns) for name, table, columns in missing
+                    if table in scanned and name not in created]
+            if not todo:
+                break
+            for name, table, columns in todo:
+                conn.execute("CREATE INDEX IF NOT EXISTS {} ON {} ({})"
+                             .format(name, table, ", ".join(columns)))
+                created.append(name)
+            conn.execute("ANALYZE")
+            conn.commit()
+
+        scans = {}
+        for shape in shapes:
+            tables = full_scans(explain_shape(conn, shape, term_index))
+            if tables:
+                scans[shape] = tables
+
+    return {"missing": [m[0] for m in missing], "created": created,
+            "scans": scans}
+
+
+def canonical_criteria(args_from_ui):
+    '''
+    Takes a dictionary containing search criteria and returns a hashable
+    form of it in which criteria that always give the same results are
+    equal: lists become tuples, and "day" and "terms", whose order does not
+    matter, are sorted
+
+    Input:
+        args_from_ui: a dictionary containing search criteria
+    Output:
+        a sorted tuple of (criterion, value) pairs
+    '''
+    items = []
+    for key, val in args_from_ui.items():
+        if key in ("day", "terms"):
+            val = tuple(sorted(val))
+        elif isinstance(val, list):
+            val = tuple(val)
+        items.append((key, val))
+    return tuple(sorted(items))
+
+
+def database_stamp(filename):
+    '''
+    Returns the modification time and size of a database file and of its
+    write-ahead log, which change whenever a change is committed
+    '''
+    stamp = []
+    for path in (filename, filename + "-wal"):
+        try:
+            st = os.stat(path)
+            stamp.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            stamp.append(None)
+    return tuple(stamp)
+
+
+class ResultCache:
+    '''
+    A thread-safe LRU cache of find_courses results, holding at most
+    "size" of them for at most "ttl" seconds each. A result is dropped as
+    soon as its database file changes.
+    '''
+
+    def __init__(self, size=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, filename, key):
+        '''
+        Return the cached (header, rows) for criteria "key" (from
+        canonical_criteria) on a database file, or None
+        '''
+        now = time.monotonic()
+        stamp = database_stamp(filename)
+        with self._lock:
+            entry = self._entries.get((filename, key))
+            if entry is not None and entry[0] > now and entry[1] == stamp:
+                self._entries.move_to_end((filename, key))
+                self.hits += 1
+                return entry[2]
+            if entry is not None:
+                del self._entries[(filename, key)]
+            self.misses += 1
+            return None
+
+    def put(self, filename, key, result, stamp):
+        '''
+        Cache a result computed while the database file had the given stamp
+        (from database_stamp, taken before the query ran)
+        '''
+        with self._lock:
+            self._entries[(filename, key)] = (time.monotonic() + self.ttl,
+                                              stamp, result)
+            self._entries.move_to_end((filename, key))
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        '''
+        Drop every cached result, e.g. after a change that does not touch
+        the database file
+        '''
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        '''
+        Return the hit and miss counters and the number of cached results
+        '''
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "entries": len(self._entries)}
+
+
+result_cache = ResultCache()
+
 
 def find_courses(args_from_ui):
     '''
@@ -148,19 +948,462 @@ def find_courses(args_from_ui):
     if not args_from_ui:
         return ([], [])
     else:
-        se_str = select_from_str(args_from_ui)
-        wh_str, args = where_str(args_from_ui)
-        # merge the string
-        q = se_str + wh_str
-        # connect to a sqlite3 database and make queries
-        conn = sqlite3.connect(DATABASE_FILENAME)
-        conn.create_function("time_between", 4, compute_time_between)
+        pool = get_pool()
+        key = canonical_criteria(args_from_ui)
+        cached = result_cache.get(pool.filename, key)
+        if cached is not None:
+            # copies, so that callers cannot change the cached result
+            return (list(cached[0]), list(cached[1]))
+        stamp = database_stamp(pool.filename)
+        # borrow a pooled connection (the UDF is already registered on it)
+        with pool.connection() as conn:
+            header, lst = run_query(conn, pool.filename, args_from_ui)
+        result_cache.put(pool.filename, key, (header, lst), stamp)
+        return (list(header), list(lst))
+
+
+def prepare_query(conn, filename, args_from_ui):
+    '''
+    Fills the connection's TEMP tables that the query for the criteria
+    reads, and returns what is needed to run it
+
+    Input:
+        conn: a CourseConnection to the file
+        filename: the database file
+        args_from_ui: a dictionary containing search criteria
+    Output:
+        term_index: whether the terms were matched by the term index
+        args: a tuple of values for the parameters of the query
+    '''
+    if "building_code" in args_from_ui:
+        fill_walk_candidates(conn, filename, args_from_ui["building_code"],
+                             args_from_ui["walking_time"])
+    term_index = USE_TERM_INDEX and "terms" in args_from_ui and \
+        fill_term_matches(conn, filename, args_from_ui["terms"])
+    wh_str, args = where_str(args_from_ui, term_index)
+    return term_index, args
+
+
+def run_query(conn, filename, args_from_ui):
+    '''
+    Runs the query for non-empty criteria on a connection to a database file
+
+    Output:
+        a pair: an ordered list of attribute names and a list of rows
+    '''
+    term_index, args = prepare_query(conn, filename, args_from_ui)
+    q = query_for_shape(criteria_shape(args_from_ui), term_index)
+    c = conn.cursor()
+    lst = c.execute(q, args).fetchall()
+    header = get_header(c)
+    c.close()
+    return header, lst
+
+
+def find_courses_many(criteria_list, workers=None):
+    '''
+    Takes a list of dictionaries containing search criteria and returns the
+    find_courses result of each, in the same order
+
+    Criteria with the same shape are run together, so that each SQL string
+    is prepared once per connection, and the groups are spread over
+    "workers" threads with a read-only connection each. SQLite releases the
+    GIL while it runs a statement, so the threads run in parallel.
+
+    Input:
+        criteria_list: a list of dictionaries containing search criteria
+        workers: the number of threads, by default the number of CPUs
+    Output:
+        a list of (header, rows) pairs
+    '''
+    for args_from_ui in criteria_list:
+        assert_valid_input(args_from_ui)
+
+    workers = workers or os.cpu_count() or 1
+    results = [([], []) for args_from_ui in criteria_list]
+    groups = {}
+    for i, args_from_ui in enumerate(criteria_list):
+        if args_from_ui:
+            groups.setdefault(criteria_shape(args_from_ui), []).append(i)
+
+    # split big groups so that every worker gets a share of them
+    chunk = max(1, min(BATCH_CHUNK_SIZE, -(-len(criteria_list) // workers)))
+    tasks = [indexes[j:j + chunk] for indexes in groups.values()
+             for j in range(0, len(indexes), chunk)]
+    if not tasks:
+        return results
+
+    pool = get_pool(readonly=True, size=workers)
+
+    def run_task(indexes):
+        with pool.connection() as conn:
+            for i in indexes:
+                results[i] = run_query(conn, pool.filename, criteria_list[i])
+
+    with ThreadPoolExecutor(min(workers, len(tasks))) as executor:
+        # list() raises the first exception of any task
+        list(executor.map(run_task, tasks))
+
+    return results
+
+
+class RunningQuery:
+    '''
+    Tracks the connection a worker thread is running a query on, so that
+    the query can be interrupted from the event loop. Cancelling also stops
+    every later statement on the connection until the worker finishes, so
+    a cancel that arrives between statements is not lost.
+    '''
+
+    def __init__(self):
+        self.conn = None
+        self.cancelled = False
+        self._lock = threading.Lock()
+
+    def start(self, conn):
+        '''
+        Called by the worker with its connection. Returns False if the query
+        was cancelled before it started.
+        '''
+        with self._lock:
+            if self.cancelled:
+                return False
+            self.conn = conn
+            # a true result aborts the statement being run
+            conn.set_progress_handler(lambda: self.cancelled,
+                                      PROGRESS_INSTRUCTIONS)
+            return True
+
+    def finish(self):
+        '''
+        Called by the worker before it gives the connection back
+        '''
+        with self._lock:
+            if self.conn is not None:
+                self.conn.set_progress_handler(None, 0)
+            self.conn = None
+
+    def cancel(self):
+        '''
+        Interrupt the statement running on the connection, if any
+        '''
+        with self._lock:
+            self.cancelled = True
+            if self.conn is not None:
+                self.conn.interrupt()
+
+
+class AsyncCourseSearch:
+    '''
+    An asyncio interface to course search. Queries run on "workers" worker
+    threads with pooled connections, at most "workers" at a time, and
+    cancelling the awaiting task interrupts the running statement.
+    '''
+
+    def __init__(self, workers=POOL_SIZE, filename=None):
+        self.workers = workers
+        self.filename = filename
+        self._executor = ThreadPoolExecutor(workers,
+                                            thread_name_prefix="course-search")
+        self._semaphore = None
+        self._loop = None
+
+    def _slots(self):
+        '''
+        Return the semaphore bounding concurrency on the running loop
+        '''
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.workers)
+            self._loop = loop
+        return self._semaphore
+
+    async def _call(self, running, func, *args):
+        '''
+        Run func(*args) on a worker thread, interrupting its query through
+        "running" if the calling task is cancelled
+        '''
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._executor, func, *args)
+        except asyncio.CancelledError:
+            running.cancel()
+            raise
+
+    def _query(self, running, args_from_ui):
+        '''
+        Worker: run the query for the criteria, as find_courses does
+        '''
+        pool = get_pool(self.filename, size=self.workers)
+        stamp = database_stamp(pool.filename)
+        with pool.connection() as conn:
+            if not running.start(conn):
+                return None
+            try:
+                header, lst = run_query(conn, pool.filename, args_from_ui)
+            except sqlite3.OperationalError:
+                conn.rollback()
+                raise
+            finally:
+                running.finish()
+        result_cache.put(pool.filename, canonical_criteria(args_from_ui),
+                         (header, lst), stamp)
+        return (list(header), list(lst))
+
+    async def find_courses(self, args_from_ui):
+        '''
+        Coroutine version of find_courses
+        '''
+        assert_valid_input(args_from_ui)
+
+        if not args_from_ui:
+            return ([], [])
+        filename = get_pool(self.filename).filename
+        cached = result_cache.get(filename, canonical_criteria(args_from_ui))
+        if cached is not None:
+            return (list(cached[0]), list(cached[1]))
+        running = RunningQuery()
+        async with self._slots():
+            return await self._call(running, self._query, running,
+                                    args_from_ui)
+
+    async def iter_courses(self, args_from_ui, batch_size=STREAM_BATCH_SIZE):
+        '''
+        Async generator version of iter_courses: yields the header, then
+        lists of up to "batch_size" rows. It holds a connection and one of
+        the concurrency slots until it is exhausted or closed.
+        '''
+        assert_valid_input(args_from_ui)
+
+        if not args_from_ui:
+            yield []
+            return
+        pool = get_pool(self.filename, size=self.workers)
+        running = RunningQuery()
+
+        def release(conn, cursor):
+            running.finish()
+            cursor.close()
+            if running.cancelled:
+                conn.rollback()
+            pool.release(conn)
+
+        def execute():
+            conn = pool.acquire()
+            if not running.start(conn):
+                pool.release(conn)
+                return None
+            c = conn.cursor()
+            try:
+                term_index, args = prepare_query(conn, pool.filename,
+                                                 args_from_ui)
+                c.execute(query_for_shape(criteria_shape(args_from_ui),
+                                          term_index), args)
+            except BaseException:
+                release(conn, c)
+                raise
+            return conn, c
+
+        def release_later(future):
+            if not future.cancelled() and future.exception() is None \
+                    and future.result() is not None:
+                release(*future.result())
+
+        def release_after_fetch(future):
+            # the task was cancelled, so an interrupted fetch is expected
+            if not future.cancelled():
+                future.exception()
+            release(conn, cursor)
+
+        async with self._slots():
+            future = asyncio.get_running_loop().run_in_executor(
+                self._executor, execute)
+            try:
+                # shielded, so that a connection it opens after the task
+                # is cancelled still goes back to the pool
+                conn, cursor = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                running.cancel()
+                future.add_done_callback(release_later)
+                raise
+            fetching = None
+            try:
+                yield get_header(cursor)
+                while True:
+                    fetching = asyncio.get_running_loop().run_in_executor(
+                        self._executor, cursor.fetchmany, batch_size)
+                    try:
+                        # shielded, so that "fetching" is only done once the
+                        # worker has let go of the cursor
+                        batch = await asyncio.shield(fetching)
+                    except asyncio.CancelledError:
+                        running.cancel()
+                        raise
+                    if not batch:
+                        break
+                    yield batch
+            finally:
+                if fetching is not None and not fetching.done():
+                    # the worker still uses the cursor: release after it
+                    fetching.add_done_callback(release_after_fetch)
+                else:
+                    release(conn, cursor)
+
+    def close(self):
+        '''
+        Stop the worker threads once their current queries finish
+        '''
+        self._executor.shutdown(wait=False)
+
+
+_async_search = None
+_async_search_lock = threading.Lock()
+
+
+def get_async_search():
+    '''
+    Return the shared AsyncCourseSearch, creating it on first use
+    '''
+    global _async_search
+    with _async_search_lock:
+        if _async_search is None:
+            _async_search = AsyncCourseSearch()
+        return _async_search
+
+
+async def find_courses_async(args_from_ui):
+    '''
+    Coroutine version of find_courses, run on the shared worker threads
+    without blocking the event loop
+    '''
+    return await get_async_search().find_courses(args_from_ui)
+
+
+def iter_courses_async(args_from_ui, batch_size=STREAM_BATCH_SIZE):
+    '''
+    Async generator yielding the header and then batches of rows for the
+    criteria, run on the shared worker threads
+    '''
+    return get_async_search().iter_courses(args_from_ui, batch_size)
+
+
+def iter_courses(args_from_ui, batch_size=STREAM_BATCH_SIZE):
+    '''
+    Takes a dictionary containing search criteria, as for find_courses, and
+    returns the header and an iterator over the matching rows, which are
+    fetched "batch_size" at a time as the iterator is consumed
+
+    The iterator holds a pooled connection until it is exhausted or closed.
+
+    Input:
+        args_from_ui: a dictionary containing search criteria
+        batch_size: rows fetched from SQLite at a time
+    Output:
+        a pair: an ordered list of attribute names and an iterator of rows
+    '''
+    assert_valid_input(args_from_ui)
+
+    if not args_from_ui:
+        return ([], iter([]))
+    rows = stream_rows(args_from_ui, batch_size)
+    # runs the query, so errors are raised here rather than while iterating
+    header = next(rows)
+    return (header, rows)
+
+
+def stream_rows(args_from_ui, batch_size):
+    '''
+    Generator behind iter_courses: yields the header, then the rows
+    '''
+    pool = get_pool()
+    with pool.connection() as conn:
+        term_index, args = prepare_query(conn, pool.filename, args_from_ui)
         c = conn.cursor()
-        r = c.execute(q, args)
-        lst = r.fetchall()
-        header = get_header(c)
-        conn.close()
-        return (header,lst)
+        try:
+            c.execute(query_for_shape(criteria_shape(args_from_ui),
+                                      term_index), args)
+            yield get_header(c)
+            while True:
+                batch = c.fetchmany(batch_size)
+                if not batch:
+                    break
+                yield from batch
+        finally:
+            c.close()
+
+
+def page_keys(shape):
+    '''
+    Takes a shape from criteria_shape and returns the SQL expressions that
+    identify a row of its query, in the order pages are sorted by
+    '''
+    keys = ["courses.course_id"]
+    criteria = set(key for key, n in shape)
+    if criteria & {"day", "enrollment", "time_start", "time_end",
+                   "building_code"}:
+        keys.append("sections.rowid")
+    if "building_code" in criteria:
+        keys.append("walk_key")
+    return keys
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def page_query(shape, term_index=False, after=False):
+    '''
+    Takes a shape from criteria_shape and returns its query sorted by
+    page_keys, with the keys selected after the other columns and a LIMIT.
+    If "after" is True, the query only returns rows whose keys come after
+    a cursor, given as extra parameters before the limit.
+    '''
+    template = {key: [None] * n if n is not None else None for key, n in shape}
+    keys = page_keys(shape)
+    se_str = select_from_str(template, term_index)
+    wh_str = where_str(template, term_index)[0]
+
+    # the keys go at the end of the SELECT part
+    at = se_str.index(" FROM courses")
+    se_str = se_str[:at] + ", " + ", ".join(keys) + se_str[at:]
+    if after:
+        cond = "(" + ", ".join(keys) + ") > (" + ", ".join("?" * len(keys)) + ")"
+        wh_str += (" AND " if wh_str else " WHERE ") + cond
+    return se_str + wh_str + " ORDER BY " + ", ".join(keys) + " LIMIT ?"
+
+
+def find_courses_page(args_from_ui, limit=PAGE_SIZE, cursor=None):
+    '''
+    Takes a dictionary containing search criteria, as for find_courses, and
+    returns one page of the results. Pages are sorted by course and section
+    and start after "cursor", so they stay consistent without OFFSET.
+
+    Input:
+        args_from_ui: a dictionary containing search criteria
+        limit: the most rows in the page
+        cursor: None for the first page, or the cursor returned with the
+                previous page
+    Output:
+        header: an ordered list of attribute names
+        rows: a list of up to "limit" rows
+        cursor: the cursor of the next page, or None after the last page
+    '''
+    assert_valid_input(args_from_ui)
+
+    if not args_from_ui:
+        return ([], [], None)
+    shape = criteria_shape(args_from_ui)
+    n = len(page_keys(shape))
+    pool = get_pool()
+    with pool.connection() as conn:
+        term_index, args = prepare_query(conn, pool.filename, args_from_ui)
+        q = page_query(shape, term_index, cursor is not None)
+        if cursor is not None:
+            args += tuple(cursor)
+        c = conn.cursor()
+        lst = c.execute(q, args + (limit,)).fetchall()
+        header = get_header(c)[:-n]
+        c.close()
+
+    next_cursor = lst[-1][-n:] if len(lst) == limit and lst else None
+    return (header, [row[:-n] for row in lst], next_cursor)
 
 
 